@@ -0,0 +1,86 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+import collections
+
+import cpu_profile
+
+
+def search_space(num_cores):
+    # one setting at a time, in this order, the others stay at the best values found so far
+    core_counts = sorted(set([max(1, num_cores // divisor) for divisor in [4, 2, 1]]))
+    return collections.OrderedDict([('intra_op_threads', core_counts),
+                                    ('omp_threads', core_counts),
+                                    ('inter_op_threads', [1, 2, 4]),
+                                    ('num_threads', [2, 4, 8, 16]),
+                                    ('kmp_blocktime', [0, 1, 200])])
+
+
+def run_trial(settings, benchmark_args):
+    # every trial is a new process, the OpenMP runtime reads its environment only once
+    command = [sys.executable, 'benchmark.py', '--mode=cpu'] + \
+              ['--{}={}'.format(key, value) for key, value in sorted(settings.items())] + benchmark_args
+    # in the folder of the scripts, whatever folder autotune.py is started from
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    output, _ = process.communicate()
+
+    match = re.search(r'ms/step: ([0-9.]+)', output)
+    if process.returncode != 0 or match is None:
+        print(' [!] trial failed: {}\n{}'.format(' '.join(command), '\n'.join(output.splitlines()[-5:])))
+        return float('inf')
+    return float(match.group(1))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='tune the cpu thread settings of the training step on a short '
+                                                 'synthetic run and save the best ones for this host, the remaining '
+                                                 'arguments are passed to benchmark.py --mode=cpu, e.g. --batch_size')
+    parser.add_argument('--profile_file', default='cpu_profiles.json',
+                        help='per host profile file that main.py reads, default: cpu_profiles.json')
+    parser.add_argument('--num_cores', type=int, default=os.cpu_count(),
+                        help='number of cores the thread counts are taken from, default: all the cores')
+    flags, benchmark_args = parser.parse_known_args(args)
+
+    # the defaults of main.py
+    best = collections.OrderedDict([('intra_op_threads', 0), ('inter_op_threads', 0), ('num_threads', 8),
+                                    ('omp_threads', 0), ('kmp_blocktime', -1)])
+    baseline_ms = best_ms = run_trial(best, benchmark_args)
+    print(' [*] defaults: {:.1f} ms/step'.format(baseline_ms))
+    if baseline_ms == float('inf'):
+        return 1
+
+    for key, values in search_space(flags.num_cores).items():
+        for value in values:
+            if value == best[key]:
+                continue
+
+            settings = collections.OrderedDict(best)
+            settings[key] = value
+            ms = run_trial(settings, benchmark_args)
+            print(' [*] {}={}: {:.1f} ms/step'.format(key, value, ms))
+            if ms < best_ms:
+                best, best_ms = settings, ms
+
+    profile = dict(best)
+    profile.update({'ms_per_step': round(best_ms, 2), 'default_ms_per_step': round(baseline_ms, 2),
+                    'tuned_at': time.strftime('%Y%m%d-%H%M'), 'benchmark_args': benchmark_args})
+    cpu_profile.save(flags.profile_file, profile)
+
+    print(' [*] {}: {:.1f} ms/step, {:.2f}x the defaults'.format(
+        ', '.join(['{}={}'.format(key, value) for key, value in best.items()]), best_ms, baseline_ms / best_ms))
+    print(' [*] Saved the profile of {} to {}'.format(cpu_profile.host_name(), flags.profile_file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
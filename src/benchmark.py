@@ -0,0 +1,560 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+import collections
+import numpy as np
+import tensorflow as tf
+
+import cpu_profile
+import tensorflow_utils as tf_utils
+import utils as utils
+from dataset import Dataset, get_spec, image_size_of
+from discogan import DiscoGAN, grow_sizes_of
+from reader import Reader
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string('mode', 'reader', 'benchmark to run from [reader, decode, augment, pool, '
+                                       'graph, infinite, sample, towers, accum, recompute, '
+                                       'progressive, xla, layout, cpu], default: reader')
+tf.flags.DEFINE_string('dataset', 'facades', 'dataset name from [edges2handbags, edges2shoes, handbags2shoes, maps, '
+                                             'cityscapes, facades], default: facades')
+tf.flags.DEFINE_bool('is_train', True, 'benchmark the train split, default: True')
+tf.flags.DEFINE_integer('image_size', 0, 'target resolution of the networks, 0 for the size of the dataset, '
+                                         'default: 0')
+tf.flags.DEFINE_integer('batch_size', 200, 'batch size, default: 200')
+tf.flags.DEFINE_list('pipelines', 'queue,dataset', 'input pipelines for the reader mode, default: queue,dataset')
+tf.flags.DEFINE_integer('pool_size', 50, 'image pool size for the pool mode, default: 50')
+tf.flags.DEFINE_integer('num_threads', 8, 'number of reader threads, default: 8')
+tf.flags.DEFINE_integer('intra_op_threads', 0, 'threads of a single op for the cpu mode, 0 for the tensorflow default, '
+                                               'default: 0')
+tf.flags.DEFINE_integer('inter_op_threads', 0, 'threads running independent ops for the cpu mode, 0 for the '
+                                               'tensorflow default, default: 0')
+tf.flags.DEFINE_integer('omp_threads', 0, 'OMP_NUM_THREADS for the cpu mode, 0 to keep the environment, default: 0')
+tf.flags.DEFINE_integer('kmp_blocktime', -1, 'KMP_BLOCKTIME in ms for the cpu mode, -1 to keep the environment, '
+                                             'default: -1')
+tf.flags.DEFINE_list('tower_counts', '1,2,4', 'numbers of towers for the towers mode, default: 1,2,4')
+tf.flags.DEFINE_string('tower_device', 'cpu', 'device type of the towers from [gpu, cpu], default: cpu')
+tf.flags.DEFINE_integer('accum_steps', 4, 'micro-batches of the accumulation for the accum mode, default: 4')
+tf.flags.DEFINE_list('batch_sizes', '64,128,200', 'batch sizes for the recompute mode, default: 64,128,200')
+tf.flags.DEFINE_list('grow_sizes', '16,32', 'smaller resolutions of the progressive mode, default: 16,32')
+tf.flags.DEFINE_float('grow_fraction', 0.7, 'fraction of the iterations at the grow_sizes, default: 0.7')
+tf.flags.DEFINE_float('target_loss', 0.1, 'cycle loss at the target size to reach in the progressive mode, '
+                                          'default: 0.1')
+tf.flags.DEFINE_integer('eval_freq', 10, 'iterations between the loss checks of the progressive mode, default: 10')
+tf.flags.DEFINE_integer('warmup', 5, 'number of warm-up batches that are not timed, default: 5')
+tf.flags.DEFINE_integer('num_batches', 50, 'number of timed batches, default: 50')
+
+
+def time_batches(sess, fetch, warmup, num_batches, feed_dict=None):
+    for _ in range(warmup):
+        sess.run(fetch, feed_dict=feed_dict)
+
+    start_time = time.time()
+    for _ in range(num_batches):
+        sess.run(fetch, feed_dict=feed_dict)
+    return time.time() - start_time
+
+
+def benchmark_reader(flags):
+    dataset = Dataset(flags.dataset, flags)
+    path = dataset(load_val=False)[0]
+
+    for pipeline in flags.pipelines:
+        with tf.Graph().as_default():
+            reader = Reader(path, name='X', image_size=dataset.image_size, batch_size=flags.batch_size,
+                            num_threads=flags.num_threads, side='left', ori_image_size=dataset.ori_image_size,
+                            pipeline=pipeline)
+            imgs = reader.feed()
+
+            with tf.Session() as sess:
+                sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+                coord = tf.train.Coordinator()
+                threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+
+                elapsed = time_batches(sess, imgs, flags.warmup, flags.num_batches)
+
+                coord.request_stop()
+                coord.join(threads)
+
+        print('[{}] pipeline: {:>8}, images/sec: {:.1f}'.format(
+            flags.dataset, pipeline, flags.batch_size * flags.num_batches / elapsed))
+
+
+def synthetic_jpeg(ori_image_size):
+    # smooth gradients with mild noise, compressed like the pix2pix side-by-side jpegs
+    h, w, c = ori_image_size
+    grid = np.linspace(0., 255., num=w)[np.newaxis, :, np.newaxis] * np.ones((h, 1, c))
+    img = np.clip(grid + np.random.normal(scale=8., size=(h, w, c)), 0., 255.).astype(np.uint8)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        return sess.run(tf.image.encode_jpeg(img, quality=95))
+
+
+def benchmark_decode(flags):
+    # ori_image_size of the pix2pix datasets: (256, 512, 3) for edges2*, cityscapes, facades and (600, 1200, 3) for maps
+    for ori_image_size in [(256, 512, 3), (600, 1200, 3)]:
+        contents = synthetic_jpeg(ori_image_size)
+
+        for fast_decode in [False, True]:
+            with tf.Graph().as_default():
+                reader = Reader(None, image_size=(64, 64, 3), side='right', ori_image_size=ori_image_size,
+                                fast_decode=fast_decode)
+                img = reader._parse(tf.constant(contents))
+
+                with tf.Session() as sess:
+                    elapsed = time_batches(sess, img, flags.warmup, flags.num_batches)
+
+            print('ori_image_size: {}, fast_decode: {!s:>5}, ratio: 1/{}, decode+preprocess: {:.3f} ms/image'.format(
+                ori_image_size, fast_decode, reader.ratio, 1000. * elapsed / flags.num_batches))
+
+
+def benchmark_augment(flags):
+    ori_image_size = (256, 512, 3)
+    for batch_size in [64, 200, 512]:
+        for batch_augment in [False, True]:
+            with tf.Graph().as_default(), tf.device('/cpu:0'):
+                reader = Reader(None, image_size=(64, 64, 3), batch_size=batch_size, side='left',
+                                ori_image_size=ori_image_size, batch_augment=batch_augment)
+                # decoded uint8 half images, kept in a variable so only the augmentation is timed
+                halves = tf.Variable(tf.random_uniform([batch_size, ori_image_size[0], ori_image_size[0], 3],
+                                                       maxval=256, dtype=tf.int32), trainable=False)
+                halves = tf.cast(halves, dtype=tf.uint8)
+
+                if batch_augment:
+                    imgs = reader._batch_augment(halves)
+                else:
+                    imgs = tf.stack([reader._augment(half) for half in tf.unstack(halves)])
+
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    elapsed = time_batches(sess, imgs.op, flags.warmup, flags.num_batches)
+
+            print('batch_size: {:>3}, batch_augment: {!s:>5}, images/sec: {:.1f}'.format(
+                batch_size, batch_augment, batch_size * flags.num_batches / elapsed))
+
+
+def benchmark_pool(flags):
+    img_shape = (64, 64, 3)
+    fake_imgs = np.random.uniform(-1., 1., size=(flags.batch_size,) + img_shape).astype(np.float32)
+
+    # image by image on the host
+    pool = utils.ImagePool(pool_size=flags.pool_size)
+    for _ in range(flags.warmup):
+        [pool.query(img) for img in fake_imgs]
+
+    start_time = time.time()
+    for _ in range(flags.num_batches):
+        np.asarray([pool.query(img) for img in fake_imgs])
+    elapsed = time.time() - start_time
+    print('utils.ImagePool,    batch_size: {}, ms/batch: {:.3f}'.format(
+        flags.batch_size, 1000. * elapsed / flags.num_batches))
+
+    # whole batch on the graph, the fake images never leave the device
+    with tf.Graph().as_default():
+        imgs = tf.Variable(fake_imgs, trainable=False)
+        pool = tf_utils.ImagePool(flags.pool_size, img_shape)
+        pooled_imgs, update_op = pool.query(imgs)
+        fetch = tf.group(tf.reduce_sum(pooled_imgs), update_op)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            elapsed = time_batches(sess, fetch, flags.warmup, flags.num_batches)
+    print('tf_utils.ImagePool, batch_size: {}, ms/batch: {:.3f}'.format(
+        flags.batch_size, 1000. * elapsed / flags.num_batches))
+
+
+def model_flags(flags, **kwargs):
+    # the main.py flags that DiscoGAN reads, with the main.py defaults
+    values = dict(dataset=flags.dataset, batch_size=flags.batch_size, iters=100000, learning_rate=2e-4, beta1=0.5,
+                  beta2=0.999, weight_decay=1e-4, pool_size=0, sample_batch=flags.batch_size, num_towers=1,
+                  tower_device='gpu', accum_steps=1, recompute=False, xla=False,
+                  data_format='NHWC', num_threads=flags.num_threads, input_pipeline='queue', fast_decode=False,
+                  batch_augment=False, shared_reader=False)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def synthetic_inputs(dataset_name, batch_size, image_size=(64, 64)):
+    # batches kept in variables, so the step time does not include the input pipeline
+    input_channel, output_channel = get_spec(dataset_name).channels
+    x_imgs = tf.Variable(tf.random_uniform([batch_size, image_size[0], image_size[1], input_channel], -1., 1.),
+                         trainable=False)
+    y_imgs = tf.Variable(tf.random_uniform([batch_size, image_size[0], image_size[1], output_channel], -1., 1.),
+                         trainable=False)
+    return x_imgs, y_imgs
+
+
+def build_model(sess, flags, model_class=DiscoGAN, size=None, inputs=None, data_path=None, **kwargs):
+    # networks for the target resolution, trained at size x size when it is given, on the Readers of data_path or
+    # on synthetic batches
+    spec = get_spec(flags.dataset)
+    target_size = image_size_of(spec, flags.image_size)
+    image_size = target_size if size is None else (size, size, target_size[2])
+    model_flags_ = model_flags(flags, **kwargs)
+    if inputs is None and data_path is None:
+        inputs = synthetic_inputs(flags.dataset, model_flags_.batch_size, image_size)
+    return model_class(sess, model_flags_, image_size, spec.ori_image_size, data_path or [None, None], inputs=inputs,
+                       target_size=target_size[0])
+
+
+class LegacyDiscoGAN(DiscoGAN):
+    # losses as they were built before every forward pass was shared: 6 generator and 6 discriminator passes
+    def _build_passes(self, x_slices, y_slices):
+        pass  # every loss builds its own passes
+
+    def _build_losses(self, x_imgs, y_imgs, tower_idx=0):
+        self.fake_y_imgs = self.G_gen(x_imgs)
+        self.fake_x_imgs = self.F_gen(y_imgs)
+        self.G_update_ops, self.F_update_ops = list(self._G_gen_train_ops), list(self._F_gen_train_ops)
+
+        recon_x_imgs = self.F_gen(self.G_gen(x_imgs))
+        recon_y_imgs = self.G_gen(self.F_gen(y_imgs))
+        self.cycle_loss = self.cycle_consistency_loss(x_imgs, y_imgs, recon_x_imgs, recon_y_imgs)
+
+        self.G_gen_loss = self.generator_loss(self.Dy_dis(self.fake_y_imgs)[1])
+        self.G_reg = self.flags.weight_decay * tf.reduce_sum(
+            [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='G')])
+        self.G_loss = self.G_gen_loss + self.cycle_loss + self.G_reg
+        self.Dy_dis_loss = self.discriminator_loss(self.Dy_dis(y_imgs)[1], self.Dy_dis(self.fake_y_imgs)[1])
+        self.Dy_dis_reg = self.flags.weight_decay * tf.reduce_sum(
+            [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='Dy')])
+        self.Dy_loss = self.Dy_dis_loss + self.Dy_dis_reg
+
+        self.F_gen_loss = self.generator_loss(self.Dx_dis(self.fake_x_imgs)[1])
+        self.F_reg = self.flags.weight_decay * tf.reduce_sum(
+            [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='F')])
+        self.F_loss = self.F_gen_loss + self.cycle_loss + self.F_reg
+        self.Dx_dis_loss = self.discriminator_loss(self.Dx_dis(x_imgs)[1], self.Dx_dis(self.fake_x_imgs)[1])
+        self.Dx_dis_reg = self.flags.weight_decay * tf.reduce_sum(
+            [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='Dx')])
+        self.Dx_loss = self.Dx_dis_loss + self.Dx_dis_reg
+
+
+def benchmark_graph(flags):
+    for name, model_class in [('legacy', LegacyDiscoGAN), ('shared', DiscoGAN)]:
+        with tf.Graph().as_default() as graph:
+            with tf.Session() as sess:
+                model = build_model(sess, flags, model_class=model_class)
+                num_ops = len(graph.get_operations())
+                flops = tf.profiler.profile(graph, options=tf.profiler.ProfileOptionBuilder.float_operation())
+
+                sess.run(tf.global_variables_initializer())
+                elapsed = time_batches(sess, model.optims, flags.warmup, flags.num_batches)
+
+        print('[{:>6}] ops: {}, training step GFLOPs: {:.2f}, ms/step: {:.1f}'.format(
+            name, num_ops, flops.total_float_ops / 1e9, 1000. * elapsed / flags.num_batches))
+
+
+def benchmark_infinite(flags):
+    with tf.Graph().as_default() as graph:
+        with tf.Session() as sess:
+            model = build_model(sess, flags)
+            sess.run(tf.global_variables_initializer())
+            graph.finalize()
+            num_ops = len(graph.get_operations())
+
+            for _ in range(flags.warmup):
+                model.test_infinitely(input_type='A', count=model.max_infinite_count)
+
+            start_time = time.time()
+            for iter_time in range(flags.num_batches):
+                model.test_infinitely(input_type='A' if np.mod(iter_time, 2) == 0 else 'B',
+                                      count=model.max_infinite_count)
+            elapsed = time.time() - start_time
+
+            assert len(graph.get_operations()) == num_ops, 'test_infinitely added ops to the graph'
+
+    print('ops: {} before and after {} calls, count: {}, ms/call: {:.1f}'.format(
+        num_ops, flags.warmup + flags.num_batches, model.max_infinite_count, 1000. * elapsed / flags.num_batches))
+
+
+def host_sample_imgs(model):
+    # sampling as it was done before, three runs with the batches going through the host
+    x_val, y_val = model.sess.run([model.x_imgs, model.y_imgs])
+    fake_y, fake_x = model.sess.run([model.fake_y_sample, model.fake_x_sample],
+                                    feed_dict={model.x_test_tfph: x_val, model.y_test_tfph: y_val})
+    fake_yxy, fake_xyx = model.sess.run([model.fake_y_sample, model.fake_x_sample],
+                                        feed_dict={model.x_test_tfph: fake_x, model.y_test_tfph: fake_y})
+    return [x_val, fake_y, y_val, fake_x, fake_xyx, fake_yxy]
+
+
+def benchmark_sample(flags):
+    with tf.Graph().as_default() as graph:
+        with tf.Session() as sess:
+            model = build_model(sess, flags)
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            graph.finalize()
+
+            for name, sample_fn in [('host', host_sample_imgs), ('fused', lambda m: m.sample_imgs())]:
+                for _ in range(flags.warmup):
+                    sample_fn(model)
+
+                start_time = time.time()
+                for _ in range(flags.num_batches):
+                    sample_fn(model)
+                elapsed = time.time() - start_time
+
+                print('[{:>5}] sample_batch: {}, ms/sample: {:.1f}'.format(
+                    name, flags.batch_size, 1000. * elapsed / flags.num_batches))
+
+
+def benchmark_towers(flags):
+    for num_towers in [int(count) for count in flags.tower_counts]:
+        run_config = tf.ConfigProto(allow_soft_placement=True)
+        if flags.tower_device == 'cpu':
+            run_config.device_count['CPU'] = num_towers
+
+        with tf.Graph().as_default():
+            with tf.Session(config=run_config) as sess:
+                model = build_model(sess, flags, num_towers=num_towers, tower_device=flags.tower_device)
+                sess.run(tf.global_variables_initializer())
+                elapsed = time_batches(sess, model.optims, flags.warmup, flags.num_batches)
+
+        print('towers: {} x {}, batch_size: {}, images/sec: {:.1f}'.format(
+            num_towers, flags.tower_device, flags.batch_size, flags.batch_size * flags.num_batches / elapsed))
+
+
+def peak_memory_mb(sess, fetch):
+    # highest allocator peak of the devices over one traced run
+    run_metadata = tf.RunMetadata()
+    sess.run(fetch, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+
+    peak_bytes = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak_bytes = max(peak_bytes, memory.peak_bytes)
+    return peak_bytes / 1024. / 1024.
+
+
+def benchmark_accum(flags):
+    # the same effective batch size, in one batch and in accum_steps micro-batches
+    if np.mod(flags.batch_size, flags.accum_steps) != 0:
+        raise ValueError('batch_size {} is not divisible by accum_steps {}'.format(flags.batch_size, flags.accum_steps))
+
+    for accum_steps in [1, flags.accum_steps]:
+        micro_batch_size = flags.batch_size // accum_steps
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                model = build_model(sess, flags, batch_size=micro_batch_size, sample_batch=micro_batch_size,
+                                    accum_steps=accum_steps)
+                sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+                peak_mb = peak_memory_mb(sess, model.optims)
+
+                for _ in range(flags.warmup):
+                    model.train_step()
+
+                start_time = time.time()
+                for _ in range(flags.num_batches):
+                    model.train_step()
+                elapsed = time.time() - start_time
+
+        print('batch_size: {:>3} x {} micro-batches, peak memory: {:.1f} MB, images/sec: {:.1f}'.format(
+            micro_batch_size, accum_steps, peak_mb, flags.batch_size * flags.num_batches / elapsed))
+
+
+def benchmark_recompute(flags):
+    print('| batch_size | recompute | peak memory (MB) | ms/step | images/sec |')
+    print('|-----------:|----------:|-----------------:|--------:|-----------:|')
+    for batch_size in [int(size) for size in flags.batch_sizes]:
+        for recompute in [False, True]:
+            with tf.Graph().as_default():
+                with tf.Session() as sess:
+                    model = build_model(sess, flags, batch_size=batch_size, sample_batch=batch_size,
+                                        recompute=recompute)
+                    sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+                    peak_mb = peak_memory_mb(sess, model.optims)
+                    elapsed = time_batches(sess, model.optims, flags.warmup, flags.num_batches)
+
+            print('| {:>10} | {!s:>9} | {:>16.1f} | {:>7.1f} | {:>10.1f} |'.format(
+                batch_size, recompute, peak_mb, 1000. * elapsed / flags.num_batches,
+                batch_size * flags.num_batches / elapsed))
+
+
+def smooth_inputs(dataset_name, batch_size, size, seed=None):
+    # low frequency scenes, new ones at every run, or the same batch of the seed at every resolution
+    scenes = []
+    for domain, channel in enumerate(get_spec(dataset_name).channels):
+        if seed is None:
+            scene = tf.random_uniform([batch_size, 8, 8, channel], -1., 1.)
+        else:
+            rng = np.random.RandomState(seed + domain)
+            scene = rng.uniform(-1., 1., size=(batch_size, 8, 8, channel)).astype(np.float32)
+        scenes.append(tf.image.resize_bilinear(scene, [size, size]))
+    return scenes
+
+
+def benchmark_progressive(flags):
+    target = image_size_of(get_spec(flags.dataset), flags.image_size)[0]
+    grow_sizes = grow_sizes_of(flags.grow_sizes, target)
+    grow_iters = int(flags.num_batches * flags.grow_fraction / len(grow_sizes))
+    schedules = [('target', [(target, flags.num_batches)]),
+                 ('progressive', [(size, grow_iters) for size in grow_sizes] +
+                  [(target, flags.num_batches - grow_iters * len(grow_sizes))])]
+    ckpt_path = os.path.join(tempfile.mkdtemp(), 'grow')
+
+    for name, stages in schedules:
+        elapsed, iter_time, reached, path = 0., 0, None, None
+        for size, num_iters in stages:
+            with tf.Graph().as_default():
+                with tf.Session() as sess:
+                    model = build_model(sess, flags, size=size, inputs=smooth_inputs(flags.dataset, flags.batch_size,
+                                                                                     size))
+                    # cycle loss of a held-out batch at the target size in inference mode, the measure both
+                    # schedules are compared on, the training batches are new scenes at every step
+                    x_eval, y_eval = smooth_inputs(flags.dataset, flags.batch_size, target, seed=0)
+                    eval_loss = model.cycle_consistency_loss(
+                        x_eval, y_eval, model.F_gen(model.G_gen(x_eval, is_train=False), is_train=False),
+                        model.G_gen(model.F_gen(y_eval, is_train=False), is_train=False))
+
+                    saver = tf.train.Saver([var for var in tf.global_variables() if var not in model.pool_variables])
+                    sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+                    if path is not None:
+                        saver.restore(sess, path)
+
+                    for _ in range(num_iters):
+                        start_time = time.time()
+                        sess.run(model.optims)
+                        elapsed += time.time() - start_time
+                        iter_time += 1
+
+                        if reached is None and np.mod(iter_time, flags.eval_freq) == 0 and \
+                                sess.run(eval_loss) <= flags.target_loss:
+                            reached = (elapsed, iter_time)
+
+                    final_loss = sess.run(eval_loss)
+                    path = saver.save(sess, ckpt_path)
+
+        print('[{:>11}] {}, train time: {:.1f} s, final cycle loss at {}x{}: {:.4f}, cycle loss {}: {}'.format(
+            name, ' -> '.join(['{}x{} for {}'.format(size, size, num_iters) for size, num_iters in stages]), elapsed,
+            target, target, final_loss, flags.target_loss,
+            'reached after {:.1f} s ({} iters)'.format(*reached) if reached is not None else 'not reached'))
+
+
+def benchmark_xla(flags):
+    # on the cpu, the compile overhead is the first run minus a steady run
+    run_config = tf.ConfigProto(device_count={'GPU': 0})
+    for xla in [False, True]:
+        with tf.Graph().as_default():
+            with tf.Session(config=run_config) as sess:
+                model = build_model(sess, flags, xla=xla)
+                sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+
+                results = []
+                for fetch in [model.optims, model.sample_ops]:
+                    start_time = time.time()
+                    sess.run(fetch)
+                    first_ms = 1000. * (time.time() - start_time)
+                    steady_ms = 1000. * time_batches(sess, fetch, flags.warmup, flags.num_batches) / flags.num_batches
+                    results.append((steady_ms, first_ms - steady_ms))
+
+        print('[xla {:>3}] batch_size: {}, ms/step: {:.1f}, step compile: {:.1f} ms, ms/sample: {:.1f}, '
+              'sample compile: {:.1f} ms'.format('on' if xla else 'off', flags.batch_size, results[0][0],
+                                                 results[0][1], results[1][0], results[1][1]))
+
+
+def layer_of(node_name):
+    # forward and gradient ops of a block, e.g. tower_0/G_1/deconv0_norm/moments/mean and
+    # gradients/tower_0/G_1/deconv0_conv2d/conv2d_transpose_grad/Conv2D both to G/deconv0
+    match = re.search(r'(?:^|/)(G|F|Dy|Dx)(?:_\d+)?/((?:de)?conv\d+)_', node_name)
+    if match is not None:
+        return '{}/{}'.format(*match.groups())
+    if '_to_data_format' in node_name:
+        return 'transpose'
+    return None
+
+
+def layer_ms(sess, fetch, num_batches):
+    # ms per step of every layer from traced runs, gpu ops from their stream:all records instead of their launches
+    totals = collections.defaultdict(float)
+    for _ in range(num_batches):
+        run_metadata = tf.RunMetadata()
+        sess.run(fetch, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            if 'gpu' in dev_stats.device.lower() and not dev_stats.device.endswith('stream:all'):
+                continue
+            for node_stats in dev_stats.node_stats:
+                layer = layer_of(node_stats.node_name)
+                if layer is not None:
+                    totals[layer] += node_stats.all_end_rel_micros / 1000. / num_batches
+    return totals
+
+
+def benchmark_layout(flags):
+    layer_times, step_times = {}, {}
+    for data_format in ['NHWC', 'NCHW']:
+        with tf.Graph().as_default():
+            with tf.Session() as sess:
+                model = build_model(sess, flags, data_format=data_format)
+                sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+                step_times[data_format] = 1000. * time_batches(sess, model.optims, flags.warmup,
+                                                               flags.num_batches) / flags.num_batches
+                layer_times[data_format] = layer_ms(sess, model.optims, flags.num_batches)
+
+    print('| layer | NHWC ms | NCHW ms | speedup |')
+    print('|:------|--------:|--------:|--------:|')
+    layers = sorted(set(layer_times['NHWC']) | set(layer_times['NCHW']))
+    for layer, nhwc_ms, nchw_ms in [(layer, layer_times['NHWC'][layer], layer_times['NCHW'][layer])
+                                    for layer in layers] + [('step', step_times['NHWC'], step_times['NCHW'])]:
+        print('| {} | {:.2f} | {:.2f} | {} |'.format(
+            layer, nhwc_ms, nchw_ms, '{:.2f}x'.format(nhwc_ms / nchw_ms) if nchw_ms > 0 else '-'))
+
+
+def benchmark_cpu(flags):
+    # training step with the Readers on synthetic jpeg files, on the cpu with the thread flags, the trial of autotune.py
+    tmp_dir = tempfile.mkdtemp()
+    data_dir = os.path.join(tmp_dir, 'train')
+    os.makedirs(data_dir)
+    contents = synthetic_jpeg(get_spec(flags.dataset).ori_image_size)
+    for idx in range(max(flags.batch_size, 100)):
+        with open(os.path.join(data_dir, '{}.jpg'.format(idx)), 'wb') as f:
+            f.write(contents)
+
+    run_config = tf.ConfigProto(device_count={'GPU': 0})
+    cpu_profile.configure(flags, run_config)
+    try:
+        with tf.Graph().as_default():
+            with tf.Session(config=run_config) as sess:
+                model = build_model(sess, flags, data_path=[data_dir, data_dir])
+                sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+                coord = tf.train.Coordinator()
+                threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+
+                elapsed = time_batches(sess, model.optims, flags.warmup, flags.num_batches)
+
+                coord.request_stop()
+                coord.join(threads)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('[cpu] {}, ms/step: {:.1f}, images/sec: {:.1f}'.format(
+        ', '.join(['{}: {}'.format(key, getattr(flags, key)) for key in cpu_profile.PROFILE_KEYS]),
+        1000. * elapsed / flags.num_batches, flags.batch_size * flags.num_batches / elapsed))
+
+
+def main(_):
+    benchmarks = {'reader': benchmark_reader, 'decode': benchmark_decode, 'augment': benchmark_augment,
+                  'pool': benchmark_pool, 'graph': benchmark_graph,
+                  'infinite': benchmark_infinite, 'sample': benchmark_sample,
+                  'towers': benchmark_towers, 'accum': benchmark_accum, 'recompute': benchmark_recompute,
+                  'progressive': benchmark_progressive, 'xla': benchmark_xla,
+                  'layout': benchmark_layout, 'cpu': benchmark_cpu}
+    if FLAGS.mode not in benchmarks:
+        raise NotImplementedError
+
+    benchmarks[FLAGS.mode](FLAGS)
+
+
+if __name__ == '__main__':
+    tf.app.run()
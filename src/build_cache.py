@@ -0,0 +1,34 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import tensorflow as tf
+
+import shard_cache
+from dataset import Dataset
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string('dataset', 'facades', 'dataset name from [edges2handbags, edges2shoes, handbags2shoes, maps, '
+                                             'cityscapes, facades], default: facades')
+tf.flags.DEFINE_bool('is_train', True, 'build the cache of the train split, default: True')
+tf.flags.DEFINE_integer('image_size', 0, 'input resolution the cache is built for, 0 for the size of the dataset, '
+                                         'default: 0')
+tf.flags.DEFINE_integer('shard_size', 4096, 'number of images for each shard, default: 4096')
+
+
+def main(_):
+    dataset = Dataset(FLAGS.dataset, FLAGS)
+    size = shard_cache.stored_size(dataset.image_size)
+
+    # handbags2shoes reads two different folders, the other datasets read the same folder twice
+    for path in sorted(set(dataset(load_val=False))):
+        print('[*] Building {}x{} cache of {}'.format(size[0], size[1], path))
+        out_dir = shard_cache.build(path, size, shard_size=FLAGS.shard_size)
+        print('[*] Saved to {}'.format(out_dir))
+
+
+if __name__ == '__main__':
+    tf.app.run()
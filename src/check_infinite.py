@@ -0,0 +1,51 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import sys
+import argparse
+import tensorflow as tf
+
+from benchmark import build_model
+
+
+def check(dataset, image_size=0, batch_size=4, num_calls=4):
+    # test_infinitely on a finalized graph, on synthetic batches so no data is needed
+    flags = argparse.Namespace(dataset=dataset, image_size=image_size, batch_size=batch_size, num_threads=1)
+    with tf.Graph().as_default() as graph:
+        with tf.Session() as sess:
+            model = build_model(sess, flags)
+            sess.run(tf.global_variables_initializer())
+            # ops added by a call raise a RuntimeError from here on
+            graph.finalize()
+            num_ops = len(graph.get_operations())
+
+            for idx in range(num_calls):
+                for input_type in ['A', 'B']:
+                    results, names = model.test_infinitely(input_type=input_type, count=model.max_infinite_count)
+                    assert len(results) == len(names) == 2 * model.max_infinite_count + 1, \
+                        'test_infinitely returned {} images for {} names'.format(len(results), len(names))
+                    assert len(graph.get_operations()) == num_ops, \
+                        'call {} with input {} added ops to the graph'.format(idx, input_type)
+
+    return num_ops
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='check that test_infinitely adds no ops to the finalized graph, '
+                                                 'on synthetic batches without data')
+    parser.add_argument('--dataset', default='facades', help='dataset name, default: facades')
+    parser.add_argument('--image_size', type=int, default=0,
+                        help='target resolution, 0 for the size of the dataset, default: 0')
+    parser.add_argument('--num_calls', type=int, default=4, help='calls for each input type, default: 4')
+    flags = parser.parse_args(args)
+
+    num_ops = check(flags.dataset, image_size=flags.image_size, num_calls=flags.num_calls)
+    print(' [*] ops: {} before and after {} calls of test_infinitely'.format(num_ops, 2 * flags.num_calls))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,148 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import glob
+import json
+import time
+import queue
+import threading
+import tensorflow as tf
+
+RECORDS_NAME = 'checkpoints.json'
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints on a background thread while the training continues.
+
+    save copies the variables to host memory in a single run, the only part the training thread waits for. The
+    background thread loads the copy into variables of its own cpu graph and writes them with a Saver, so
+    tf.train.Saver restores them as before. The retention keeps the last keep_last checkpoints, the ones of every
+    keep_every iterations and the keep_best ones with the lowest tracked metric, and deletes the others. A checkpoint
+    that fails on the background thread is raised by the next save or by close.
+    """
+    def __init__(self, save_dir, model_name='model', keep_last=5, keep_every=0, keep_best=0, on_saved=None):
+        self.save_dir = save_dir
+        self.model_name = model_name
+        self.keep_last, self.keep_every, self.keep_best = keep_last, keep_every, keep_best
+        # on_saved(step, path, stall_ms, save_ms) on the background thread after every checkpoint
+        self.on_saved = on_saved
+        self.records = self._load_records()
+        # (step, exception) of the last failed checkpoint, raised on the training thread
+        self.error = None
+
+        # variables of the background graph, built again when the saved variables change, e.g. the image pools of
+        # the next size in progressive training
+        self.signature, self.sess = None, None
+
+        # one snapshot in memory at a time, the next save waits for the previous one to be written
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, name='checkpointer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _load_records(self):
+        # steps, files and metrics of the kept checkpoints, from the last run when training continues
+        path = os.path.join(self.save_dir, RECORDS_NAME)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+
+        ckpt = tf.train.get_checkpoint_state(self.save_dir)
+        paths = ckpt.all_model_checkpoint_paths if ckpt else []
+        return [{'step': int(path.split('-')[-1]), 'path': os.path.basename(path), 'metric': None} for path in paths]
+
+    def save(self, sess, step, var_list=None, metric=None):
+        start_time = time.time()
+        self.queue.join()  # the previous checkpoint is still being written
+        self._raise_error()
+
+        var_list = tf.global_variables() if var_list is None else var_list
+        values = sess.run(var_list)
+        signature = tuple([(var.op.name, var.dtype.base_dtype, tuple(var.get_shape().as_list())) for var in var_list])
+        self.queue.put((signature, values, step, metric, 1000. * (time.time() - start_time)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            signature, values, step, metric, stall_ms = item
+            try:
+                start_time = time.time()
+                path = self._write(signature, values, step)
+                self._retain(step, path, metric)
+                if self.on_saved is not None:
+                    self.on_saved(step, path, stall_ms, 1000. * (time.time() - start_time))
+            except Exception as e:
+                self.error = step, e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            (step, error), self.error = self.error, None
+            raise RuntimeError('checkpoint of iter_time {} failed: {}'.format(step, error)) from error
+
+    def _write(self, signature, values, step):
+        if signature != self.signature:
+            if self.sess is not None:
+                self.sess.close()
+
+            graph = tf.Graph()
+            with graph.as_default(), tf.device('/cpu:0'):
+                self.placeholders = [tf.placeholder(dtype, shape) for _, dtype, shape in signature]
+                # the checkpoint keeps the names of the training graph
+                variables = {name: tf.Variable(placeholder, trainable=False, name='var_{}'.format(idx))
+                             for idx, ((name, _, _), placeholder) in enumerate(zip(signature, self.placeholders))}
+                self.init_op = tf.variables_initializer(list(variables.values()))
+                self.saver = tf.train.Saver(variables, max_to_keep=None)
+            self.sess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+            self.signature = signature
+
+        self.sess.run(self.init_op, feed_dict=dict(zip(self.placeholders, values)))
+        return self.saver.save(self.sess, os.path.join(self.save_dir, self.model_name), global_step=step,
+                               write_meta_graph=False, write_state=False)
+
+    def _retain(self, step, path, metric):
+        records = [record for record in self.records if record['step'] != step]
+        records.append({'step': step, 'path': os.path.basename(path), 'metric': metric})
+        records.sort(key=lambda record: record['step'])
+
+        keep = {step}
+        if self.keep_last > 0:
+            keep.update([record['step'] for record in records[-self.keep_last:]])
+        if self.keep_every > 0:
+            keep.update([record['step'] for record in records if (record['step'] + 1) % self.keep_every == 0])
+        if self.keep_best > 0:
+            scored = sorted([record for record in records if record['metric'] is not None],
+                            key=lambda record: record['metric'])
+            keep.update([record['step'] for record in scored[:self.keep_best]])
+
+        for record in records:
+            if record['step'] not in keep:
+                for filename in glob.glob(os.path.join(self.save_dir, record['path']) + '.*'):
+                    os.remove(filename)
+        self.records = [record for record in records if record['step'] in keep]
+
+        # relative paths, get_checkpoint_state resolves them against save_dir
+        tf.train.update_checkpoint_state(self.save_dir, os.path.basename(path),
+                                         all_model_checkpoint_paths=[record['path'] for record in self.records])
+        tmp_path = os.path.join(self.save_dir, RECORDS_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.records, f, indent=2)
+        os.rename(tmp_path, os.path.join(self.save_dir, RECORDS_NAME))
+
+    def close(self):
+        # waits for the last checkpoint
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        if self.sess is not None:
+            self.sess.close()
+        self._raise_error()
@@ -0,0 +1,64 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import json
+import socket
+
+# thread settings of a cpu execution profile, the flags of the same names in main.py and benchmark.py
+PROFILE_KEYS = ['intra_op_threads', 'inter_op_threads', 'num_threads', 'omp_threads', 'kmp_blocktime']
+
+
+def host_name():
+    return socket.gethostname()
+
+
+def load_all(path):
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def load(path, host=None):
+    # profile of this host in the per host file written by autotune.py, None if it was not tuned yet
+    return load_all(path).get(host or host_name())
+
+
+def save(path, profile, host=None):
+    profiles = load_all(path)
+    profiles[host or host_name()] = profile
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def resolve(flags, path):
+    """Fills the thread flags from the saved profile of this host.
+
+    Flags given on the command line win over the profile and the profile wins over the defaults. Returns the
+    settings in effect.
+    """
+    profile = load(path) or {}
+    for key in PROFILE_KEYS:
+        if key in profile and not flags[key].present:
+            setattr(flags, key, profile[key])
+    return {key: getattr(flags, key) for key in PROFILE_KEYS}
+
+
+def configure(flags, run_config):
+    # thread pools of the session, 0 for the tensorflow default
+    run_config.intra_op_parallelism_threads = flags.intra_op_threads
+    run_config.inter_op_parallelism_threads = flags.inter_op_threads
+
+    # OpenMP runtime of the oneDNN (MKL) builds, read when the first op runs so it is set before the first session
+    if flags.omp_threads > 0:
+        os.environ['OMP_NUM_THREADS'] = str(flags.omp_threads)
+        os.environ.setdefault('KMP_AFFINITY', 'granularity=fine,compact,1,0')
+    if flags.kmp_blocktime >= 0:
+        os.environ['KMP_BLOCKTIME'] = str(flags.kmp_blocktime)
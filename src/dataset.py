@@ -4,102 +4,273 @@
 # Written by Cheng-Bin Jin
 # Email: sbkim0407@gmail.com
 # ---------------------------------------------------------
+import os
+import collections
+import multiprocessing
+import threading
+import queue
 import numpy as np
 import utils as utils
 import cv2
 
+import manifest
+from shard_cache import split_pair
+
+# image_size is the network input, ori_image_size the side-by-side pix2pix file, and folders, sides and channels are
+# given for the (A, B) domains
+DatasetSpec = collections.namedtuple('DatasetSpec', ['image_size', 'ori_image_size', 'folders', 'sides', 'channels'])
+
+DATASETS = {
+    'edges2handbags': DatasetSpec(image_size=(64, 64, 3), ori_image_size=(256, 512, 3),
+                                  folders=('edges2handbags', 'edges2handbags'), sides=('left', 'right'),
+                                  channels=(1, 3)),
+    'edges2shoes': DatasetSpec(image_size=(64, 64, 3), ori_image_size=(256, 512, 3),
+                               folders=('edges2shoes', 'edges2shoes'), sides=('left', 'right'), channels=(1, 3)),
+    'cityscapes': DatasetSpec(image_size=(64, 64, 3), ori_image_size=(256, 512, 3),
+                              folders=('cityscapes', 'cityscapes'), sides=('left', 'right'), channels=(3, 3)),
+    'facades': DatasetSpec(image_size=(64, 64, 3), ori_image_size=(256, 512, 3),
+                           folders=('facades', 'facades'), sides=('left', 'right'), channels=(3, 3)),
+    'maps': DatasetSpec(image_size=(64, 64, 3), ori_image_size=(600, 1200, 3),
+                        folders=('maps', 'maps'), sides=('left', 'right'), channels=(3, 3)),
+    'handbags2shoes': DatasetSpec(image_size=(64, 64, 3), ori_image_size=(256, 256, 3),
+                                  folders=('edges2handbags', 'edges2shoes'), sides=('right', 'right'),
+                                  channels=(3, 3)),
+}
+
+
+def get_spec(dataset_name):
+    if dataset_name not in DATASETS:
+        raise NotImplementedError
+    return DATASETS[dataset_name]
+
+
+def image_size_of(spec, size=0):
+    # image_size of the spec, or size x size when it is given, e.g. 128 for (128, 128, 3)
+    if size == 0:
+        return spec.image_size
+    return size, size, spec.image_size[2]
+
 
 class Original(object):
     def __init__(self, flags):
         self.flags = flags
         self.dataset_name = flags.dataset
-        self.image_size = (64, 64, 3)
-        if self.flags.dataset == 'edges2shoes' or self.flags.dataset == 'edges2handbags' or \
-                self.flags.dataset == 'cityscapes' or self.flags.dataset == 'facades':
-            self.ori_image_size = (256, 512, 3)
-        elif self.flags.dataset == 'maps':
-            self.ori_image_size = (600, 1200, 3)
-
-        self.train_path = '../../Data/{}/train'.format(self.dataset_name)
-        self.val_path = '../../Data/{}/val'.format(self.dataset_name)
+        self.spec = get_spec(self.dataset_name)
+        self.image_size = image_size_of(self.spec, flags.image_size)
+        self.ori_image_size = self.spec.ori_image_size
+
+        self.train_path = '../../Data/{}/train'.format(self.spec.folders[0])
+        self.val_path = '../../Data/{}/val'.format(self.spec.folders[0])
         self.data_x, self.data_y = None, None
 
-    def __call__(self):
+    def __call__(self, load_val=True):
+        # paths of the (A, B) folders, the val split is also read into memory with load_val
         if self.flags.is_train:
             return [self.train_path, self.train_path]
         else:
-            self.read_val_data()
+            if load_val:
+                self.read_val_data()
             return [self.val_path, self.val_path]
 
     def read_val_data(self):
-        imgs_x, imgs_y = [], []
-        val_path = utils.all_files_under(self.val_path)
-        for path in val_path:
-            x, y = utils.load_data(path, flip=False, is_test=True, is_gray_scale=False,
-                                   transform_type='zero_center', img_size=self.ori_image_size)
-            # scipy.misc.imresize reutrns uint8 type
-            x = cv2.resize(x, dsize=None, fx=0.25, fy=0.25)  # (256, 256, 3) to (64, 64, 3)
-            y = cv2.resize(y, dsize=None, fx=0.25, fy=0.25)  # (256, 256, 3) to (64, 64, 3)
-
-            imgs_x.append(x)
-            imgs_y.append(y)
+        self.data_x, self.data_y = read_val_pairs(self.val_path, self.dataset_name, self.ori_image_size,
+                                                  self.image_size)
 
-        self.data_x = np.asarray(imgs_x).astype(np.float32)  # list to array
-        self.data_y = np.asarray(imgs_y).astype(np.float32)  # list to array
+    def val_stream(self, batch_size, max_memory_mb=256):
+        filenames = manifest.load(self.val_path).paths(extension='.jpg')
+        return ValStream(filenames, filenames, 'left', 'right', self.image_size, batch_size,
+                         max_memory_mb=max_memory_mb)
 
 
 class Bags2Shoes(object):
     def __init__(self, flags):
         self.flags = flags
         self.dataset_name = flags.dataset
-        self.image_size = (64, 64, 3)
-        self.ori_image_size = (256, 256, 3)
+        self.spec = get_spec(self.dataset_name)
+        self.image_size = image_size_of(self.spec, flags.image_size)
+        self.ori_image_size = self.spec.ori_image_size
 
-        self.bags_train_path = '../../Data/edges2handbags/train'
-        self.shoes_train_path = '../../Data/edges2shoes/train'
+        self.bags_train_path = '../../Data/{}/train'.format(self.spec.folders[0])
+        self.shoes_train_path = '../../Data/{}/train'.format(self.spec.folders[1])
 
-        self.bags_val_path = '../../Data/edges2handbags/val'
-        self.shoes_val_path = '../../Data/edges2shoes/val'
+        self.bags_val_path = '../../Data/{}/val'.format(self.spec.folders[0])
+        self.shoes_val_path = '../../Data/{}/val'.format(self.spec.folders[1])
 
         self.data_x, self.data_y = None, None
 
-    def __call__(self):
+    def __call__(self, load_val=True):
+        # paths of the (A, B) folders, the val split is also read into memory with load_val
         if self.flags.is_train:
             return [self.bags_train_path, self.shoes_train_path]
         else:
-            self.read_val_data()
+            if load_val:
+                self.read_val_data()
             return [self.bags_val_path, self.shoes_val_path]
 
     def read_val_data(self):
-        bags, shoeses = [], []
-        bags_val_path = utils.all_files_under(self.bags_val_path)
-        shoes_val_path = utils.all_files_under(self.shoes_val_path)
+        # right half of the pix2pix images
+        _, self.data_x = read_val_pairs(self.bags_val_path, self.dataset_name, self.ori_image_size, self.image_size)
+        _, self.data_y = read_val_pairs(self.shoes_val_path, self.dataset_name, self.ori_image_size, self.image_size)
+
+    def val_stream(self, batch_size, max_memory_mb=256):
+        return ValStream(manifest.load(self.bags_val_path).paths(extension='.jpg'),
+                         manifest.load(self.shoes_val_path).paths(extension='.jpg'),
+                         'right', 'right', self.image_size, batch_size, max_memory_mb=max_memory_mb)
+
+
+class ValStream(object):
+    """Iterates over (x, y) validation batches without holding the whole split in memory.
+
+    A background thread decodes the files into uint8 batches and keeps at most max_memory_mb of them ready; they
+    are converted to float32 [-1., 1.] only when yielded. Every batch has batch_size images, the shorter file list
+    and the last batch wrap around to the beginning of the split. An error of the background thread is raised by the
+    iteration, and the thread stops when the iteration is left early.
+    """
+    def __init__(self, x_files, y_files, x_side, y_side, image_size, batch_size, max_memory_mb=256):
+        self.x_files, self.y_files = x_files, y_files
+        self.x_side, self.y_side = x_side, y_side
+        self.image_size = image_size
+        self.batch_size = batch_size
+
+        batch_bytes = 2 * batch_size * int(np.prod(image_size))
+        self.max_batches = max(1, int(max_memory_mb * 1024 * 1024 / batch_bytes))
+        self.num_batches = int(np.ceil(max(len(x_files), len(y_files)) / batch_size))
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.max_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop))
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+
+                x_batch, y_batch = batch
+                yield utils.transform(x_batch.astype(np.float32)), utils.transform(y_batch.astype(np.float32))
+        finally:
+            # also when the consumer stops early, the producer may be waiting for a free slot
+            stop.set()
+            thread.join()
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self._batches():
+                if not self._put(batches, batch, stop):
+                    return
+            self._put(batches, None, stop)
+        except Exception as e:
+            # raised again in the consumer, which would otherwise wait forever
+            self._put(batches, e, stop)
 
-        # read bags data
-        for bag_path in bags_val_path:
-            _, bag = utils.load_data(bag_path, flip=False, is_test=True, is_gray_scale=False,
-                                     transform_type='zero_center', img_size=self.ori_image_size)
-            # scipy.misc.imresize reutrns uint8 type
-            bag = cv2.resize(bag, dsize=None, fx=0.25, fy=0.25)  # (256, 256, 3) to (64, 64, 3)
-            bags.append(bag)
+    @staticmethod
+    def _put(batches, item, stop):
+        # blocks while max_batches are waiting, which bounds the memory, until the consumer is gone
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-        for shoes_path in shoes_val_path:
-            _, shoes = utils.load_data(shoes_path, flip=False, is_test=True, is_gray_scale=False,
-                                       transform_type='zero_center', img_size=self.ori_image_size)
-            # scipy.misc.imresize reutrns uint8 type
-            shoes = cv2.resize(shoes, dsize=None, fx=0.25, fy=0.25)  # (256, 256, 3) to (64, 64, 3)
-            shoeses.append(shoes)
+    def _batches(self):
+        for batch_idx in range(self.num_batches):
+            x_batch = np.empty((self.batch_size,) + tuple(self.image_size), dtype=np.uint8)
+            y_batch = np.empty((self.batch_size,) + tuple(self.image_size), dtype=np.uint8)
 
-        self.data_x = np.asarray(bags).astype(np.float32)  # list to array
-        self.data_y = np.asarray(shoeses).astype(np.float32)  # list to array
+            for idx in range(self.batch_size):
+                pos = batch_idx * self.batch_size + idx
+                x_path = self.x_files[pos % len(self.x_files)]
+                y_path = self.y_files[pos % len(self.y_files)]
+
+                x_img = self._read(x_path)
+                # paired datasets keep both domains in one file, decode it once
+                y_img = x_img if y_path == x_path else self._read(y_path)
+                x_batch[idx] = self._resize(split_pair(x_img)[self.x_side])
+                y_batch[idx] = self._resize(split_pair(y_img)[self.y_side])
+
+            yield x_batch, y_batch
+
+    @staticmethod
+    def _read(path):
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise IOError('could not decode {}'.format(path))
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def _resize(self, img):
+        # cv2.resize takes dsize as (width, height)
+        return cv2.resize(img, dsize=(self.image_size[1], self.image_size[0]), interpolation=cv2.INTER_AREA)
+
+
+def _load_val_pair(args):
+    path, ori_image_size, image_size = args
+    x, y = utils.load_data(path, flip=False, is_test=True, is_gray_scale=False, transform_type='zero_center',
+                           img_size=ori_image_size)
+    # (256, 256, 3) to (64, 64, 3), cv2.resize takes dsize as (width, height)
+    x = cv2.resize(x, dsize=(image_size[1], image_size[0]))
+    y = cv2.resize(y, dsize=(image_size[1], image_size[0]))
+    return x, y
+
+
+def read_val_pairs(val_path, dataset_name, ori_image_size, image_size, num_workers=None, use_cache=True):
+    """Decodes the A and B halves of all files under val_path in a process pool.
+
+    The result is saved as .npy files keyed by dataset, resolution and file list fingerprint, and later calls with
+    the same files memory-map them instead of decoding again.
+    """
+    val_manifest = manifest.load(val_path)
+    filenames = val_manifest.paths(extension='.jpg')
+    cache_dir = val_path.rstrip('/') + '_cache'
+    fingerprint = val_manifest.fingerprint(extension='.jpg')
+    cache_paths = [os.path.join(cache_dir, '{}_{}_{}x{}_{}.npy'.format(
+        dataset_name, domain, image_size[0], image_size[1], fingerprint)) for domain in ['A', 'B']]
+
+    if use_cache and all([os.path.isfile(path) for path in cache_paths]):
+        print(' [*] Load cached val data of {}'.format(val_path))
+        return [np.load(path, mmap_mode='r') for path in cache_paths]
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # preallocated arrays that the decoded images are written into, renamed only when complete
+    shape = (len(filenames), image_size[0], image_size[1], image_size[2])
+    arrs = [np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32, shape=shape)
+            for path in cache_paths]
+
+    pool = multiprocessing.Pool(processes=num_workers)
+    try:
+        args = [(path, ori_image_size, image_size) for path in filenames]
+        for idx, (x, y) in enumerate(pool.imap(_load_val_pair, args, chunksize=16)):
+            arrs[0][idx], arrs[1][idx] = x, y
+    finally:
+        pool.close()
+        pool.join()
+
+    for arr in arrs:
+        arr.flush()
+    del arrs
+
+    for path in cache_paths:
+        os.rename(path + '.tmp', path)
+
+    return [np.load(path, mmap_mode='r') for path in cache_paths]
 
 
 # noinspection PyPep8Naming
 def Dataset(dataset_name, flags):
-    if dataset_name == 'handbags2shoes':
-        return Bags2Shoes(flags)
-    elif dataset_name == 'edges2handbags' or dataset_name == 'edges2shoes' or dataset_name == 'maps' or \
-            dataset_name == 'cityscapes' or dataset_name == 'facades':
+    spec = get_spec(dataset_name)
+    if spec.folders[0] == spec.folders[1]:
+        # both domains are the halves of the same pix2pix files
         return Original(flags)
     else:
-        raise NotImplementedError
+        return Bags2Shoes(flags)
@@ -4,7 +4,9 @@
 # Written by Cheng-Bin Jin, based on code from vanhuyz
 # Email: sbkim0407@gmail.com
 # ---------------------------------------------------------
+import sys
 import collections
+import functools
 import numpy as np
 # import matplotlib as mpl
 import tensorflow as tf
@@ -14,63 +16,159 @@ import tensorflow as tf
 
 import tensorflow_utils as tf_utils
 import utils as utils
-from reader import Reader
+from dataset import get_spec
+from reader import Reader, PairReader
+
+# losses of one training step, in the order train_step returns them
+LOSS_NAMES = ['G_loss', 'G_gen_loss', 'G_reg', 'F_loss', 'F_gen_loss', 'F_reg', 'cycle_loss', 'Dy_loss', 'Dy_dis_loss',
+              'Dy_dis_reg', 'Dx_loss', 'Dx_dis_loss', 'Dx_dis_reg']
 
 
 # noinspection PyPep8Naming
 class DiscoGAN(object):
-    def __init__(self, sess, flags, image_size, ori_image_size, data_path):
+    def __init__(self, sess, flags, image_size, ori_image_size, data_path, inputs=None, shard_index=0, num_shards=1,
+                 local_device=None, target_size=None):
         self.sess = sess
         self.flags = flags
         self.image_size = image_size
+        # the depth of the networks follows the target resolution, image_size can be smaller in progressive training
+        self.target_size = image_size[0] if target_size is None else target_size
         self.ori_image_size = ori_image_size
         self.x_path, self.y_path = data_path[0], data_path[1]
+        # (x_imgs, y_imgs) tensors that replace the Readers, e.g. synthetic batches for benchmarks
+        self.inputs = inputs
+        # distributed training: the file shard of this worker and its device for the variables it keeps for itself
+        self.shard_index, self.num_shards = shard_index, num_shards
+        self.local_device = local_device
 
         self.norm = 'batch'
         self.lambda1, self.lambda2 = 1.0, 1.0
         self.ngf, self.ndf = 64, 64
         self.eps = 1e-12
+        self.max_infinite_count = 5  # longest A -> B -> A ... chain of test_infinitely
         self.start_decay_step = int(np.ceil(self.flags.iters / 2))  # for optimizer
         self.decay_steps = self.flags.iters - self.start_decay_step
 
         self._G_gen_train_ops, self._F_gen_train_ops = [], []
         self._Dy_dis_train_ops, self._Dx_dis_train_ops = [], []
+        self._pool_ops = []
+        self.pool_variables = []
+        self.global_steps = []  # of the four optimizers
 
         self._build_net()
         self._tensorboard()
         self._cal_grid_size()
 
     def _build_net(self):
-        if (self.flags.dataset == 'edges2handbags') or (self.flags.dataset == 'edges2shoes'):
-            side_1, side_2 = 'left', 'right'
-            self.input_channel = 1
-            self.output_channel = 3
-        elif self.flags.dataset == 'handbags2shoes':
-            side_1, side_2 = 'right', 'right'
-            self.input_channel = 3
-            self.output_channel = 3
+        spec = get_spec(self.flags.dataset)
+        side_1, side_2 = spec.sides
+        self.input_channel, self.output_channel = spec.channels
+
+        # fixed sample batch kept on the device, local variables so they are not part of the checkpoints
+        with tf.device(self.local_device):
+            self.x_sample = tf.Variable(tf.zeros([self.flags.batch_size, self.image_size[0], self.image_size[1],
+                                                  self.input_channel]), trainable=False, name='A_sample',
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            self.y_sample = tf.Variable(tf.zeros([self.flags.batch_size, self.image_size[0], self.image_size[1],
+                                                  self.output_channel]), trainable=False, name='B_sample',
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        self._sample_cached = False
+
+        # tfph: tensorflow placeholder, reads the sample batch when nothing is fed
+        self.x_test_tfph = tf.placeholder_with_default(
+            self.x_sample.read_value(), shape=[None, self.image_size[0], self.image_size[1], self.input_channel],
+            name='A_test_tfph')
+        self.y_test_tfph = tf.placeholder_with_default(
+            self.y_sample.read_value(), shape=[None, self.image_size[0], self.image_size[1], self.output_channel],
+            name='B_test_tfph')
+
+        net_kwargs = dict(norm=self.norm, recompute=self.flags.recompute, image_size=self.target_size,
+                          data_format=self.flags.data_format,
+                          devices=[self.tower_device(idx) for idx in range(self.flags.num_towers)])
+        self.G_gen = Generator(name='G', ngf=self.ngf, output_channel=self.output_channel, _ops=self._G_gen_train_ops,
+                               **net_kwargs)
+        self.Dy_dis = Discriminator(name='Dy', ndf=self.ndf, _ops=self._Dy_dis_train_ops, **net_kwargs)
+        self.F_gen = Generator(name='F', ngf=self.ngf, output_channel=self.input_channel, _ops=self._F_gen_train_ops,
+                               **net_kwargs)
+        self.Dx_dis = Discriminator(name='Dx', ndf=self.ndf, _ops=self._Dx_dis_train_ops, **net_kwargs)
+
+        if self.inputs is None:
+            self._build_readers(side_1, side_2)
         else:
-            side_1, side_2 = 'left', 'right'
-            self.input_channel = 3
-            self.output_channel = 3
-
-        # tfph: tensorflow placeholder
-        self.x_test_tfph = tf.placeholder(
-            tf.float32, shape=[None, self.image_size[0], self.image_size[1], self.input_channel], name='A_test_tfph')
-        self.y_test_tfph = tf.placeholder(
-            tf.float32, shape=[None, self.image_size[0], self.image_size[1], self.output_channel], name='B_test_tfph')
-
-        self.G_gen = Generator(name='G', ngf=self.ngf, norm=self.norm, output_channel=self.output_channel,
-                               _ops=self._G_gen_train_ops)
-        self.Dy_dis = Discriminator(name='Dy', ndf=self.ndf, norm=self.norm, _ops=self._Dy_dis_train_ops)
-        self.F_gen = Generator(name='F', ngf=self.ngf, norm=self.norm, output_channel=self.input_channel,
-                               _ops=self._F_gen_train_ops)
-        self.Dx_dis = Discriminator(name='Dx', ndf=self.ndf, norm=self.norm, _ops=self._Dx_dis_train_ops)
-
-        x_reader = Reader(self.x_path, name='X', image_size=self.image_size, batch_size=self.flags.batch_size,
-                          side=side_1, ori_image_size=self.ori_image_size)
-        y_reader = Reader(self.y_path, name='Y', image_size=self.image_size, batch_size=self.flags.batch_size,
-                          side=side_2, ori_image_size=self.ori_image_size)
+            self.x_imgs, self.y_imgs = self.inputs
+        self.cache_sample_op = tf.group(tf.assign(self.x_sample, self.x_imgs), tf.assign(self.y_sample, self.y_imgs))
+
+        # the training step of the four networks and the sampling graph are compiled with XLA when flags.xla is set
+        with tf_utils.jit_scope(self.flags.xla):
+            self._build_towers()
+
+            # G_optim = tf.train.AdamOptimizer(
+            #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
+            #     self.G_loss, var_list=self.G_gen.variables, name='Adam_G')
+            # Dy_optim = tf.train.AdamOptimizer(
+            #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
+            #     self.Dy_loss, var_list=self.Dy_dis.variables, name='Adam_Dy')
+            # F_optim = tf.train.AdamOptimizer(
+            #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
+            #     self.F_loss, var_list=self.F_gen.variables, name='Adam_F')
+            # Dx_optim = tf.train.AdamOptimizer(
+            #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
+            #     self.Dx_loss, var_list=self.Dx_dis.variables, name='Adam_Dx')
+            G_optim = self.optimizer(losses=self.tower_losses['G_loss'], variables=self.G_gen.variables, name='Adam_G',
+                                     update_ops=self.G_update_ops)
+            Dy_optim = self.optimizer(losses=self.tower_losses['Dy_dis_loss'], variables=self.Dy_dis.variables,
+                                      name='Adam_Dy')
+            F_optim = self.optimizer(losses=self.tower_losses['F_loss'], variables=self.F_gen.variables, name='Adam_F',
+                                     update_ops=self.F_update_ops)
+            Dx_optim = self.optimizer(losses=self.tower_losses['Dx_dis_loss'], variables=self.Dx_dis.variables,
+                                      name='Adam_Dx')
+            # with gradient accumulation optims adds the gradients of one micro-batch and apply_optims updates the
+            # variables once every accum_steps micro-batches
+            self.optims = tf.group([optim for optim, _ in [G_optim, Dy_optim, F_optim, Dx_optim]] + self._pool_ops)
+            self.apply_optims = None
+            if self.flags.accum_steps > 1:
+                self.apply_optims = tf.group([apply for _, apply in [G_optim, Dy_optim, F_optim, Dx_optim]])
+
+            # for sampling function, inference mode with the moving statistics of batch norm
+            fake_y_sample = self.G_gen(tf_utils.to_data_format(self.x_test_tfph, self.flags.data_format),
+                                       is_train=False)
+            fake_x_sample = self.F_gen(tf_utils.to_data_format(self.y_test_tfph, self.flags.data_format),
+                                       is_train=False)
+
+            # for test_infinitely function, the alternating chains are built once here and every call only runs a
+            # prefix, every link goes back to NHWC for the host
+            self.infinite_chains = {
+                'A': [tf_utils.from_data_format(output, self.flags.data_format)
+                      for output in self._build_chain(fake_y_sample, [self.F_gen, self.G_gen])],
+                'B': [tf_utils.from_data_format(output, self.flags.data_format)
+                      for output in self._build_chain(fake_x_sample, [self.G_gen, self.F_gen])]}
+            self.fake_y_sample, self.fake_x_sample = self.infinite_chains['A'][0], self.infinite_chains['B'][0]
+
+            # A, AB, B, BA, ABA, BAB in a single run, the reconstructions are the second links of the chains
+            self.sample_ops = [self.x_test_tfph, self.fake_y_sample, self.y_test_tfph, self.fake_x_sample,
+                               self.infinite_chains['A'][1], self.infinite_chains['B'][1]]
+
+    def _build_chain(self, first_output, generators):
+        outputs = [first_output]
+        for step in range(2 * self.max_infinite_count - 1):
+            outputs.append(generators[np.mod(step, 2)](outputs[-1], is_train=False))
+        return outputs
+
+    def _build_readers(self, side_1, side_2):
+        reader_kwargs = dict(image_size=self.image_size, batch_size=self.flags.batch_size,
+                             num_threads=self.flags.num_threads, ori_image_size=self.ori_image_size,
+                             pipeline=self.flags.input_pipeline, fast_decode=self.flags.fast_decode,
+                             batch_augment=self.flags.batch_augment,
+                             shard_index=self.shard_index, num_shards=self.num_shards)
+
+        if self.flags.shared_reader and (self.x_path == self.y_path) and (side_1, side_2) == ('left', 'right'):
+            # both domains are the halves of the same files, read and decode every file only once
+            xy_reader = PairReader(self.x_path, name='XY', left_channel=self.input_channel, **reader_kwargs)
+            self.x_imgs, self.y_imgs = xy_reader.feed()
+            return
+
+        x_reader = Reader(self.x_path, name='X', side=side_1, **reader_kwargs)
+        y_reader = Reader(self.y_path, name='Y', side=side_2, **reader_kwargs)
 
         if self.input_channel == 1:
             imgs = x_reader.feed()
@@ -79,57 +177,117 @@ class DiscoGAN(object):
             self.x_imgs = x_reader.feed()
         self.y_imgs = y_reader.feed()
 
+    def tower_device(self, tower_idx):
+        if self.flags.num_towers == 1:
+            return None  # default placement
+        return tf_utils.tower_device('/{}:{}'.format(self.flags.tower_device, tower_idx))
+
+    def _build_towers(self):
+        # data parallel: every tower gets a slice of the batch and shares the variables kept on the cpu
+        if np.mod(self.flags.batch_size, self.flags.num_towers) != 0:
+            raise ValueError('batch_size {} is not divisible by num_towers {}'.format(
+                self.flags.batch_size, self.flags.num_towers))
+
+        self.tower_losses = {name: [] for name in LOSS_NAMES}
+        # the only transpose of the training step, the Readers give NHWC batches
+        x_slices = tf.split(tf_utils.to_data_format(self.x_imgs, self.flags.data_format, name='x_to_data_format'),
+                            self.flags.num_towers, axis=0)
+        y_slices = tf.split(tf_utils.to_data_format(self.y_imgs, self.flags.data_format, name='y_to_data_format'),
+                            self.flags.num_towers, axis=0)
+
+        self._build_passes(x_slices, y_slices)
+        for tower_idx in range(self.flags.num_towers):
+            with tf_utils.device_scope(self.tower_device(tower_idx)), tf.name_scope('tower_{}'.format(tower_idx)):
+                self._build_losses(x_slices[tower_idx], y_slices[tower_idx], tower_idx=tower_idx)
+
+            if tower_idx == 0:
+                # one copy of the moving statistics, updated with the moments of the whole batch
+                update_ops = self.G_update_ops, self.F_update_ops
+            for name in LOSS_NAMES:
+                self.tower_losses[name].append(getattr(self, name))
+
+        self.G_update_ops, self.F_update_ops = update_ops
+        if self.flags.num_towers > 1:
+            for name in LOSS_NAMES:
+                setattr(self, name, tf.reduce_mean(self.tower_losses[name]))
+
+    def _build_passes(self, x_slices, y_slices):
+        # every distinct forward pass is built once and shared by all the losses: 4 generator passes and 4
+        # discriminator passes (2 more discriminator passes on the history with the image pool). A pass takes the
+        # slices of all the towers and builds every layer on all of them before the next one, so batch norm
+        # normalizes them with the moments of the whole batch as on one device
+        passes = {'fake_y': self.G_gen(x_slices), 'fake_x': self.F_gen(y_slices)}
+        # the moving statistics follow the passes on real images, the inputs the generators get at inference
+        self.G_update_ops, self.F_update_ops = list(self._G_gen_train_ops), list(self._F_gen_train_ops)
+        passes['recon_x'] = self.F_gen(passes['fake_y'])
+        passes['recon_y'] = self.G_gen(passes['fake_x'])
+
+        _, passes['dy_real'] = self.Dy_dis(y_slices)
+        _, passes['dy_fake'] = self.Dy_dis(passes['fake_y'])
+        _, passes['dx_real'] = self.Dx_dis(x_slices)
+        _, passes['dx_fake'] = self.Dx_dis(passes['fake_x'])
+
+        # with the image pool the discriminators learn from the history and the generators from the latest fakes
+        passes['dy_pooled'], passes['dx_pooled'] = passes['dy_fake'], passes['dx_fake']
+        if self.flags.pool_size > 0:
+            pooled_y, pooled_x = [], []
+            for tower_idx in range(self.flags.num_towers):
+                # every tower keeps its own history
+                suffix = '' if tower_idx == 0 else '_{}'.format(tower_idx)
+                with tf_utils.device_scope(self.tower_device(tower_idx)):
+                    pooled_y.append(self.pooled(passes['fake_y'][tower_idx], 'fake_y' + suffix))
+                    pooled_x.append(self.pooled(passes['fake_x'][tower_idx], 'fake_x' + suffix))
+            _, passes['dy_pooled'] = self.Dy_dis(pooled_y)
+            _, passes['dx_pooled'] = self.Dx_dis(pooled_x)
+
+        # [tensor of every tower] of every pass
+        self.tower_passes = passes
+
+    def _build_losses(self, x_imgs, y_imgs, tower_idx=0):
+        # the losses of one tower on its slice of the passes
+        passes = {name: tensors[tower_idx] for name, tensors in self.tower_passes.items()}
+        self.fake_y_imgs, self.fake_x_imgs = passes['fake_y'], passes['fake_x']
+        self.recon_x_imgs, self.recon_y_imgs = passes['recon_x'], passes['recon_y']
+        dy_logit_real, dy_logit_fake, dy_logit_pooled = passes['dy_real'], passes['dy_fake'], passes['dy_pooled']
+        dx_logit_real, dx_logit_fake, dx_logit_pooled = passes['dx_real'], passes['dx_fake'], passes['dx_pooled']
+
         # cycle consistency loss
-        self.cycle_loss = self.cycle_consistency_loss(self.x_imgs, self.y_imgs)
+        self.cycle_loss = self.cycle_consistency_loss(x_imgs, y_imgs, self.recon_x_imgs, self.recon_y_imgs)
 
         # X -> Y
-        self.fake_y_imgs = self.G_gen(self.x_imgs)
-        self.G_gen_loss = self.generator_loss(self.Dy_dis, self.fake_y_imgs)
+        self.G_gen_loss = self.generator_loss(dy_logit_fake)
         self.G_reg = self.flags.weight_decay * tf.reduce_sum(
             [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='G')])
         self.G_loss = self.G_gen_loss + self.cycle_loss + self.G_reg
 
-        self.Dy_dis_loss = self.discriminator_loss(self.Dy_dis, self.y_imgs, self.fake_y_imgs)
+        self.Dy_dis_loss = self.discriminator_loss(dy_logit_real, dy_logit_pooled)
         self.Dy_dis_reg = self.flags.weight_decay * tf.reduce_sum(
             [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='Dy')])
         self.Dy_loss = self.Dy_dis_loss + self.Dy_dis_reg
 
         # Y -> X
-        self.fake_x_imgs = self.F_gen(self.y_imgs)
-        self.F_gen_loss = self.generator_loss(self.Dx_dis, self.fake_x_imgs)
+        self.F_gen_loss = self.generator_loss(dx_logit_fake)
         self.F_reg = self.flags.weight_decay * tf.reduce_sum(
             [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='F')])
         self.F_loss = self.F_gen_loss + self.cycle_loss + self.F_reg
 
-        self.Dx_dis_loss = self.discriminator_loss(self.Dx_dis, self.x_imgs, self.fake_x_imgs)
+        self.Dx_dis_loss = self.discriminator_loss(dx_logit_real, dx_logit_pooled)
         self.Dx_dis_reg = self.flags.weight_decay * tf.reduce_sum(
             [tf.nn.l2_loss(weight) for weight in tf.get_collection(key=tf.GraphKeys.TRAINABLE_VARIABLES, scope='Dx')])
         self.Dx_loss = self.Dx_dis_loss + self.Dx_dis_reg
 
-        # G_optim = tf.train.AdamOptimizer(
-        #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
-        #     self.G_loss, var_list=self.G_gen.variables, name='Adam_G')
-        # Dy_optim = tf.train.AdamOptimizer(
-        #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
-        #     self.Dy_loss, var_list=self.Dy_dis.variables, name='Adam_Dy')
-        # F_optim = tf.train.AdamOptimizer(
-        #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
-        #     self.F_loss, var_list=self.F_gen.variables, name='Adam_F')
-        # Dx_optim = tf.train.AdamOptimizer(
-        #     learning_rate=self.flags.learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).minimize(
-        #     self.Dx_loss, var_list=self.Dx_dis.variables, name='Adam_Dx')
-        G_optim = self.optimizer(loss=self.G_loss, variables=self.G_gen.variables, name='Adam_G')
-        Dy_optim = self.optimizer(loss=self.Dy_dis_loss, variables=self.Dy_dis.variables, name='Adam_Dy')
-        F_optim = self.optimizer(loss=self.F_loss, variables=self.F_gen.variables, name='Adam_F')
-        Dx_optim = self.optimizer(loss=self.Dx_dis_loss, variables=self.Dx_dis.variables, name='Adam_Dx')
-        self.optims = tf.group([G_optim, Dy_optim, F_optim, Dx_optim])
-
-        # for sampling function
-        self.fake_y_sample = self.G_gen(self.x_test_tfph)
-        self.fake_x_sample = self.F_gen(self.y_test_tfph)
-
-    def optimizer(self, loss, variables, name='Adam'):
+    def pooled(self, fake_imgs, name):
+        # discriminators see a history of generated images instead of only the latest batch
+        pool = tf_utils.ImagePool(self.flags.pool_size, fake_imgs.get_shape().as_list()[1:],
+                                  name='{}_pool'.format(name))
+        pooled_imgs, update_op = pool.query(fake_imgs)
+        self._pool_ops.append(update_op)
+        self.pool_variables.extend([pool.pool, pool.num_imgs])
+        return pooled_imgs
+
+    def optimizer(self, losses, variables, name='Adam', update_ops=None):
         global_step = tf.Variable(0, trainable=False)
+        self.global_steps.append(global_step)
         starter_learning_rate = self.flags.learning_rate
         end_learning_rate = 0.
         start_decay_step = self.start_decay_step
@@ -142,36 +300,63 @@ class DiscoGAN(object):
                                   starter_learning_rate))
         tf.summary.scalar('learning_rate/{}'.format(name), learning_rate)
 
-        learn_step = tf.train.AdamOptimizer(learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2).\
-            minimize(loss, global_step=global_step, var_list=variables, name=name)
-
-        return learn_step
-
-    def cycle_consistency_loss(self, x_imgs, y_imgs):
+        optim = tf.train.AdamOptimizer(learning_rate, beta1=self.flags.beta1, beta2=self.flags.beta2)
+        tower_grads = []
+        for tower_idx, loss in enumerate(losses):
+            with tf_utils.device_scope(self.tower_device(tower_idx)):
+                tower_grads.append(optim.compute_gradients(loss, var_list=variables,
+                                                           colocate_gradients_with_ops=len(losses) > 1))
+
+        grads_and_vars = tf_utils.average_gradients(tower_grads)
+
+        if self.flags.accum_steps == 1:
+            # batch norm moving averages are updated with every step
+            with tf.control_dependencies(update_ops or []):
+                learn_step = optim.apply_gradients(grads_and_vars, global_step=global_step, name=name)
+            return learn_step, None
+
+        # gradient accumulation: the mean gradient of accum_steps micro-batches in local variables, so the
+        # checkpoints stay the same, and global_step counts the applied updates only
+        accums = []
+        for grad, var in grads_and_vars:
+            # next to the variable, or on the worker itself in distributed training
+            with tf.device(self.local_device) if self.local_device is not None else tf.colocate_with(var):
+                accums.append(tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                          name=var.op.name.replace('/', '_') + '_accum',
+                                          collections=[tf.GraphKeys.LOCAL_VARIABLES]))
+
+        with tf.control_dependencies(update_ops or []):
+            accum_step = tf.group([tf.assign_add(accum, grad / self.flags.accum_steps)
+                                   for accum, (grad, _) in zip(accums, grads_and_vars) if grad is not None],
+                                  name='{}_accum'.format(name))
+
+        apply_step = optim.apply_gradients([(accum, var) for accum, (_, var) in zip(accums, grads_and_vars)],
+                                           global_step=global_step, name=name)
+        with tf.control_dependencies([apply_step]):
+            apply_step = tf.group([tf.assign(accum, tf.zeros_like(accum)) for accum in accums])
+
+        return accum_step, apply_step
+
+    def cycle_consistency_loss(self, x_imgs, y_imgs, recon_x_imgs, recon_y_imgs):
         # use mean squared error
-        forward_loss = tf.reduce_mean(tf.losses.mean_squared_error(labels=x_imgs,
-                                                                   predictions=self.F_gen(self.G_gen(x_imgs))))
-        backward_loss = tf.reduce_mean(tf.losses.mean_squared_error(labels=y_imgs,
-                                                                    predictions=self.G_gen(self.F_gen(y_imgs))))
+        forward_loss = tf.reduce_mean(tf.losses.mean_squared_error(labels=x_imgs, predictions=recon_x_imgs))
+        backward_loss = tf.reduce_mean(tf.losses.mean_squared_error(labels=y_imgs, predictions=recon_y_imgs))
         loss = self.lambda1 * forward_loss + self.lambda2 * backward_loss
         return loss
 
     @staticmethod
-    def generator_loss(dis_obj, fake_img):
+    def generator_loss(d_logit_fake):
         # loss = -tf.reduce_mean(tf.log(dis_obj(fake_img) + self.eps))
-        _, d_logit_fake = dis_obj(fake_img)
         loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=d_logit_fake,
                                                                       labels=tf.ones_like(d_logit_fake)))
         return loss
 
     @staticmethod
-    def discriminator_loss(dis_obj, real_img, fake_img):
+    def discriminator_loss(d_logit_real, d_logit_fake):
         # error_real = -tf.reduce_mean(tf.log(dis_obj(real_img) + self.eps))
         # error_fake = -tf.reduce_mean(tf.log(1. - dis_obj(fake_img) + self.eps))
         # loss = 0.5 * (error_real + error_fake)
 
-        _, d_logit_real = dis_obj(real_img)
-        _, d_logit_fake = dis_obj(fake_img)
         d_loss_real = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=d_logit_real,
                                                                              labels=tf.ones_like(d_logit_real)))
         d_loss_fake = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=d_logit_fake,
@@ -196,30 +381,35 @@ class DiscoGAN(object):
         tf.summary.scalar('loss/Dx_dis_reg', self.Dx_dis_reg)
         self.summary_op = tf.summary.merge_all()
 
-    def train_step(self):
-        ops = [self.optims, self.G_loss, self.F_loss, self.Dy_loss, self.Dx_loss, self.summary_op, self.G_gen_loss,
-               self.G_reg, self.F_gen_loss, self.F_reg, self.cycle_loss, self.Dy_dis_loss, self.Dy_dis_reg,
-               self.Dx_dis_loss, self.Dx_dis_reg]
-        # ops_1 = [self.G_gen_loss, self.G_reg, self.F_gen_loss, self.F_reg, self.cycle_loss, self.Dy_dis_loss,
-        #          self.Dy_dis_reg, self.Dx_dis_loss, self.Dx_dis_reg]
+    def train_step(self, fetch_metrics=True):
+        # accum_steps - 1 micro-batches only add their gradients, the losses are of the last one
+        for _ in range(self.flags.accum_steps - 1):
+            self.sess.run(self.optims)
 
-        _, G_loss, F_loss, Dy_loss, Dx_loss, summary, G_gen_loss, G_reg, F_gen_loss, F_reg, cycle_loss, Dy_dis_loss, \
-        Dy_dis_reg, Dx_dis_loss, Dx_dis_reg = self.sess.run(ops)
-        # G_gen_loss, G_reg, F_gen_loss, F_reg, cycle_loss, Dy_dis_loss, Dy_dis_reg, Dx_dis_loss, Dx_dis_reg = \
-        #     self.sess.run(ops_1)
+        # the losses and the summaries come back to python only when they are written, (None, None) otherwise
+        loss, summary = None, None
+        if fetch_metrics:
+            _, loss, summary = self.sess.run([self.optims, [getattr(self, name) for name in LOSS_NAMES],
+                                              self.summary_op])
+        else:
+            self.sess.run(self.optims)
+        if self.apply_optims is not None:
+            self.sess.run(self.apply_optims)
 
-        return [G_loss, G_gen_loss, G_reg, F_loss, F_gen_loss, F_reg, cycle_loss, Dy_loss, Dy_dis_loss, Dy_dis_reg,
-                Dx_loss, Dx_dis_loss, Dx_dis_reg], summary
+        return loss, summary
+
+    @staticmethod
+    def metrics(loss):
+        return collections.OrderedDict(zip(LOSS_NAMES, loss))
 
     def sample_imgs(self):
-        x_val, y_val = self.sess.run([self.x_imgs, self.y_imgs])
-        fake_y, fake_x = self.sess.run([self.fake_y_sample, self.fake_x_sample],
-                                       feed_dict={self.x_test_tfph: x_val, self.y_test_tfph: y_val})
-        fake_yxy, fake_xyx = self.sess.run([self.fake_y_sample, self.fake_x_sample],
-                                           feed_dict={self.x_test_tfph: fake_x, self.y_test_tfph: fake_y})
+        # one batch is taken from the readers the first time only, the same images are translated afterwards
+        if not self._sample_cached:
+            self.sess.run(self.cache_sample_op)
+            self._sample_cached = True
 
         names = ['A', 'AB', 'B', 'BA', 'ABA', 'BAB']
-        return [x_val, fake_y, y_val, fake_x, fake_xyx, fake_yxy], names
+        return self.sess.run(self.sample_ops), names
 
     def test_step(self, x_img, y_img):
         if self.input_channel == 1:
@@ -227,55 +417,51 @@ class DiscoGAN(object):
         else:
             x_img = x_img
 
-        fake_y, fake_x = self.sess.run([self.fake_y_sample, self.fake_x_sample],
-                                       feed_dict={self.x_test_tfph: x_img, self.y_test_tfph: y_img})
-        fake_yxy, fake_xyx = self.sess.run([self.fake_y_sample, self.fake_x_sample],
-                                           feed_dict={self.x_test_tfph: fake_x, self.y_test_tfph: fake_y})
-
         names = ['A', 'AB', 'B', 'BA', 'ABA', 'BAB']
-        return [x_img, fake_y, y_img, fake_x, fake_xyx, fake_yxy], names
+        return self.sess.run(self.sample_ops, feed_dict={self.x_test_tfph: x_img, self.y_test_tfph: y_img}), names
 
     def test_infinitely(self, input_type, count=5):
+        if count > self.max_infinite_count:
+            raise ValueError('count should be at most {}, got {}'.format(self.max_infinite_count, count))
+
         x_val, y_val = self.sess.run([self.x_imgs, self.y_imgs])
 
         if input_type.upper() == 'A':
-            iterator = [self.G_gen(self.x_test_tfph), self.F_gen(self.y_test_tfph)] * count
             input_img = x_val
             add_name = ['B', 'A']
-            place_holder = [self.x_test_tfph, self.y_test_tfph]
+            place_holder = self.x_test_tfph
         elif input_type.upper() == 'B':
-            iterator = [self.F_gen(self.y_test_tfph), self.G_gen(self.x_test_tfph)] * count
             input_img = y_val
             add_name = ['A', 'B']
-            place_holder = [self.y_test_tfph, self.x_test_tfph]
-
+            place_holder = self.y_test_tfph
         else:
             raise NotImplementedError
 
-        results = [input_img]
+        # the whole chain in one run, no new ops are added to the graph
+        outputs = self.sess.run(self.infinite_chains[input_type.upper()][:2 * count],
+                                feed_dict={place_holder: input_img})
+
+        results = [input_img] + outputs
         names = [input_type]
-        for step, model in enumerate(iterator):
+        for step in range(2 * count):
             names.append(names[-1] + add_name[np.mod(step, 2)])
-            output_img = self.sess.run(model, feed_dict={place_holder[np.mod(step, 2)]: input_img})
-            results.append(output_img)
-            input_img = output_img
 
         return results, names
 
-    def print_info(self, loss, iter_time):
-        if np.mod(iter_time, self.flags.print_freq) == 0:
-            ord_output = collections.OrderedDict([('cur_iter', iter_time), ('tar_iters', self.flags.iters),
-                                                  ('batch_size', self.flags.batch_size),
-                                                  ('G_loss', loss[0]), ('G_gen_loss', loss[1]),
-                                                  ('G_reg', loss[2]), ('F_loss', loss[3]),
-                                                  ('F_gen_loss', loss[4]), ('F_reg', loss[5]),
-                                                  ('cycle_loss', loss[6]), ('Dy_loss', loss[7]),
-                                                  ('Dy_dis_loss', loss[8]), ('Dy_dis_reg', loss[9]),
-                                                  ('Dx_loss', loss[10]), ('Dx_dis_loss', loss[11]),
-                                                  ('Dx_dis_reg', loss[12]), ('dataset', self.flags.dataset),
-                                                  ('gpu_index', self.flags.gpu_index)])
-
-            utils.print_metrics(iter_time, ord_output)
+    def print_info(self, metrics, iter_time):
+        if self.flags.metrics_format != 'print':
+            # one line, the full records are in the metrics file
+            print(' [{}/{}] {}'.format(iter_time, self.flags.iters, ', '.join(
+                ['{}: {:.4f}'.format(name, value) for name, value in metrics.items()])))
+            sys.stdout.flush()
+            return
+
+        ord_output = collections.OrderedDict([('cur_iter', iter_time), ('tar_iters', self.flags.iters),
+                                              ('batch_size', self.flags.batch_size)])
+        ord_output.update(metrics)
+        ord_output.update([('dataset', self.flags.dataset), ('gpu_index', self.flags.gpu_index)])
+
+        utils.print_metrics(iter_time, ord_output)
 
     def plots(self, imgs, iter_time, save_file, names=None):
         canvas = len(imgs)
@@ -295,78 +481,174 @@ class DiscoGAN(object):
         self.grid_cols, self.grid_rows = int(ruler), int(self.flags.sample_batch / ruler)
 
 
+def num_blocks(image_size, bottleneck=4):
+    # stride 2 blocks from image_size down to a bottleneck x bottleneck map, 4 for 64x64 as in the paper
+    num = int(np.round(np.log2(image_size / bottleneck)))
+    if num < 1 or bottleneck * 2 ** num != image_size:
+        raise ValueError('image size should be {} times a power of 2, got {}'.format(bottleneck, image_size))
+    return num
+
+
+def grow_sizes_of(sizes, image_size):
+    # smaller sizes that the networks of image_size map to themselves, the bottleneck of the smallest is 1 x 1
+    sizes = [int(size) for size in sizes]
+    min_size = 2 ** num_blocks(image_size)
+    for size in sizes:
+        if size < min_size or size >= image_size or size & (size - 1) != 0:
+            raise ValueError('grow_sizes should be powers of 2 from {} to {} for image size {}, got {}'.format(
+                min_size, image_size // 2, image_size, size))
+    if sorted(set(sizes)) != sizes:
+        raise ValueError('grow_sizes should be strictly increasing, got {}'.format(','.join(map(str, sizes))))
+    return sizes
+
+
+def norm_on_towers(xs, net, _ops, name, is_train=True):
+    # batch norm of the slices of all the towers with the moments of the whole batch, the other norms per slice
+    if net.norm == 'batch' and len(xs) > 1:
+        # variables on the device of the variables of the first tower, the moments of every slice on its own
+        with tf_utils.device_scope(net.devices[0]):
+            return tf_utils.batch_norm(list(xs), name=name, _ops=_ops, is_train=is_train, data_format=net.data_format)
+    return tf_utils.on_towers(lambda x: tf_utils.norm(x, name=name, _type=net.norm, _ops=_ops, is_train=is_train,
+                                                      data_format=net.data_format), xs, net.devices)
+
+
+def block_dims(num, base_dim):
+    # 64, 128, 256, 512, 512, ... for base_dim 64
+    return [min(2 ** idx, 8) * base_dim for idx in range(num)]
+
+
 class Generator(object):
-    def __init__(self, name=None, ngf=64, norm='instance', output_channel=3, _ops=None):
+    def __init__(self, name=None, ngf=64, norm='instance', output_channel=3, _ops=None, recompute=False,
+                 image_size=64, data_format='NHWC', devices=None):
         self.name = name
         self.ngf = ngf
         self.output_channel = output_channel
-        self.conv_dims = [self.ngf, 2*self.ngf, 4*self.ngf, 8*self.ngf]
-        self.deconv_dims = [4*self.ngf, 2*self.ngf, self.ngf]
+        self.conv_dims = block_dims(num_blocks(image_size), self.ngf)
+        self.deconv_dims = self.conv_dims[-2::-1]
         self.norm = norm
         self._ops = _ops
+        # keep only the block outputs for the backward pass and recompute the activations inside the blocks
+        self.recompute = recompute
+        # layout of the inputs and of every layer, NHWC or NCHW
+        self.data_format = data_format
+        # device of every tower, a call on the list of the tower slices builds every layer on all of them
+        self.devices = devices
         self.reuse = False
 
-    def __call__(self, x):
-        with tf.variable_scope(self.name, reuse=self.reuse):
-            tf_utils.print_activations(x)
-
-            # conv: (N, H, W, C) -> (N, H/2, W/2, 64)
-            output = tf_utils.conv2d(x, self.conv_dims[0], k_h=4, k_w=4, d_h=2, d_w=2, padding='SAME',
-                                     name='conv0_conv2d')
-            output = tf_utils.lrelu(output, name='conv0_lrelu', is_print=True)
+    def __call__(self, x, is_train=True):
+        # recompute_grad works on resource variables
+        with tf.variable_scope(self.name, reuse=self.reuse, use_resource=self.recompute or None):
+            output = x if isinstance(x, list) else [x]
+            tf_utils.print_activations(output[0])
+            recompute = self.recompute and is_train
 
-            for idx, conv_dim in enumerate(self.conv_dims[1:]):
-                # conv: (N, H/2, W/2, C) -> (N, H/4, W/4, 2C)
-                output = tf_utils.conv2d(output, conv_dim, k_h=4, k_w=4, d_h=2, d_w=2, padding='SAME',
-                                         name='conv{}_conv2d'.format(idx+1))
-                output = tf_utils.norm(output, _type=self.norm, _ops=self._ops, name='conv{}_norm'.format(idx+1))
-                output = tf_utils.lrelu(output, name='conv{}_lrelu'.format(idx+1), is_print=True)
+            for idx, conv_dim in enumerate(self.conv_dims):
+                # conv: (N, H, W, C) -> (N, H/2, W/2, 64), then (N, H/2, W/2, C) -> (N, H/4, W/4, 2C)
+                output = tf_utils.recompute(functools.partial(
+                    self._conv_block, idx=idx, conv_dim=conv_dim, is_train=is_train), recompute)(*output)
 
             for idx, deconv_dim in enumerate(self.deconv_dims):
                 # deconv: (N, H/16, W/16, C) -> (N, W/8, H/8, C/2)
-                output = tf_utils.deconv2d(output, deconv_dim, k_h=4, k_w=4, name='deconv{}_conv2d'.format(idx))
-                output = tf_utils.norm(output, _type=self.norm, _ops=self._ops, name='deconv{}_norm'.format(idx))
-                output = tf_utils.relu(output, name='deconv{}_relu'.format(idx), is_print=True)
+                output = tf_utils.recompute(functools.partial(
+                    self._deconv_block, idx=idx, deconv_dim=deconv_dim, is_train=is_train), recompute)(*output)
 
             # conv: (N, H/2, W/2, 64) -> (N, W, H, 3)
-            output = tf_utils.deconv2d(output, self.output_channel, k_h=4, k_w=4, name='conv3_deconv2d')
-            output = tf_utils.tanh(output, name='conv4_tanh', is_print=True)
+            output = tf_utils.recompute(self._output_block, recompute)(*output)
 
             # set reuse=True for next call
             self.reuse = True
             self.variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=self.name)
-            return output
+            return list(output) if isinstance(x, list) else output[0]
+
+    def _conv_block(self, *xs, idx, conv_dim, is_train, is_recomputing=False):
+        output = tf_utils.on_towers(lambda x: tf_utils.conv2d(
+            x, conv_dim, k_h=4, k_w=4, d_h=2, d_w=2, padding='SAME', name='conv{}_conv2d'.format(idx),
+            data_format=self.data_format), xs, self.devices)
+        if idx > 0:
+            # batch norm updates are added once, not again when the block is recomputed
+            output = norm_on_towers(output, self, _ops=[] if is_recomputing else self._ops, is_train=is_train,
+                                    name='conv{}_norm'.format(idx))
+        return tf_utils.on_towers(lambda x: tf_utils.lrelu(x, name='conv{}_lrelu'.format(idx), is_print=True),
+                                  output, self.devices)
+
+    def _deconv_block(self, *xs, idx, deconv_dim, is_train, is_recomputing=False):
+        output = tf_utils.on_towers(lambda x: tf_utils.deconv2d(
+            x, deconv_dim, k_h=4, k_w=4, name='deconv{}_conv2d'.format(idx), data_format=self.data_format),
+            xs, self.devices)
+        output = norm_on_towers(output, self, _ops=[] if is_recomputing else self._ops, is_train=is_train,
+                                name='deconv{}_norm'.format(idx))
+        return tf_utils.on_towers(lambda x: tf_utils.relu(x, name='deconv{}_relu'.format(idx), is_print=True),
+                                  output, self.devices)
+
+    def _output_block(self, *xs):
+        return tf_utils.on_towers(lambda x: tf_utils.tanh(tf_utils.deconv2d(
+            x, self.output_channel, k_h=4, k_w=4, name='conv3_deconv2d', data_format=self.data_format),
+            name='conv4_tanh', is_print=True), xs, self.devices)
+
+    def folded_weights(self, sess):
+        # weights of a norm='none' Generator with the frozen batch norm of every layer folded into the conv before
+        values = sess.run({var.op.name[len(self.name)+1:]: var for var in tf.global_variables(scope=self.name + '/')})
+
+        folded = {'conv0_conv2d/w': values['conv0_conv2d/w'], 'conv0_conv2d/biases': values['conv0_conv2d/biases'],
+                  'conv3_deconv2d/w': values['conv3_deconv2d/w'],
+                  'conv3_deconv2d/biases': values['conv3_deconv2d/biases']}
+        layers = [('conv{}'.format(idx+1), 3) for idx in range(len(self.conv_dims) - 1)] + \
+                 [('deconv{}'.format(idx), 2) for idx in range(len(self.deconv_dims))]  # output channels of w
+        for layer, channel_axis in layers:
+            conv, norm = layer + '_conv2d/', layer + '_norm/'
+            folded[conv + 'w'], folded[conv + 'biases'] = tf_utils.fold_batch_norm(
+                values[conv + 'w'], values[conv + 'biases'], values[norm + 'beta'], values[norm + 'gamma'],
+                values[norm + 'moving_mean'], values[norm + 'moving_variance'], channel_axis=channel_axis)
+        return folded
 
 
 class Discriminator(object):
-    def __init__(self, name=None, ndf=64, norm='instance', _ops=None):
+    def __init__(self, name=None, ndf=64, norm='instance', _ops=None, recompute=False, image_size=64,
+                 data_format='NHWC', devices=None):
         self.name = name
         self.ndf = ndf
-        self.hidden_dims = [self.ndf, 2*self.ndf, 4*self.ndf, 8*self.ndf]
+        self.hidden_dims = block_dims(num_blocks(image_size), self.ndf)
         self.norm = norm
         self._ops = _ops
+        # keep only the block outputs for the backward pass and recompute the activations inside the blocks
+        self.recompute = recompute
+        # layout of the inputs and of every layer, NHWC or NCHW
+        self.data_format = data_format
+        # device of every tower, a call on the list of the tower slices builds every layer on all of them
+        self.devices = devices
         self.reuse = False
 
     def __call__(self, x):
-        with tf.variable_scope(self.name, reuse=self.reuse):
-            tf_utils.print_activations(x)
-
-            # conv: (N, H, W, 3) -> (N, H/2, W/2, 64)
-            output = tf_utils.conv2d(x, self.ndf, k_h=4, k_w=4, d_h=2, d_w=2, padding='SAME', name='conv0_conv2d')
-            output = tf_utils.lrelu(output, name='conv0_lrelu', is_print=True)
+        # recompute_grad works on resource variables
+        with tf.variable_scope(self.name, reuse=self.reuse, use_resource=self.recompute or None):
+            output = x if isinstance(x, list) else [x]
+            tf_utils.print_activations(output[0])
 
-            for idx, hidden_dim in enumerate(self.hidden_dims[1:]):
-                # conv: (N, H/2, W/2, C) -> (N, H/4, W/4, C/2)
-                output = tf_utils.conv2d(output, hidden_dim, k_h=4, k_w=4, d_h=2, d_w=2, padding='SAME',
-                                         name='conv{}_conv2d'.format(idx+1))
-                output = tf_utils.norm(output, _type=self.norm, _ops=self._ops, name='conv{}_norm'.format(idx+1))
-                output = tf_utils.lrelu(output, name='conv{}_lrelu'.format(idx+1), is_print=True)
+            for idx, hidden_dim in enumerate(self.hidden_dims):
+                # conv: (N, H, W, 3) -> (N, H/2, W/2, 64), then (N, H/2, W/2, C) -> (N, H/4, W/4, C/2)
+                output = tf_utils.recompute(functools.partial(
+                    self._conv_block, idx=idx, hidden_dim=hidden_dim), self.recompute)(*output)
 
             # conv: (N, H/16, W/16, 512) -> (N, H/16, W/16, 1)
-            output = tf_utils.conv2d(output, 1, k_h=4, k_w=4, d_h=1, d_w=1, padding='SAME', name='conv4_conv2d')
+            output = tf_utils.on_towers(lambda x_: tf_utils.conv2d(
+                x_, 1, k_h=4, k_w=4, d_h=1, d_w=1, padding='SAME', name='conv4_conv2d', data_format=self.data_format),
+                list(output), self.devices)
+            probs = tf_utils.on_towers(tf_utils.sigmoid, output, self.devices)
 
             # set reuse=True for next call
             self.reuse = True
             self.variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=self.name)
 
-            return tf_utils.sigmoid(output), output
+            if isinstance(x, list):
+                return probs, output
+            return probs[0], output[0]
+
+    def _conv_block(self, *xs, idx, hidden_dim, is_recomputing=False):
+        output = tf_utils.on_towers(lambda x: tf_utils.conv2d(
+            x, hidden_dim, k_h=4, k_w=4, d_h=2, d_w=2, padding='SAME', name='conv{}_conv2d'.format(idx),
+            data_format=self.data_format), xs, self.devices)
+        if idx > 0:
+            output = norm_on_towers(output, self, _ops=[] if is_recomputing else self._ops,
+                                    name='conv{}_norm'.format(idx))
+        return tf_utils.on_towers(lambda x: tf_utils.lrelu(x, name='conv{}_lrelu'.format(idx), is_print=True),
+                                  output, self.devices)
@@ -1,42 +1,265 @@
-import wget
+import io
 import os
+import sys
+import shutil
+import socket
+import hashlib
+import argparse
 import tarfile
+import http.client
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
-cwd = os.getcwd()
-handbag_url = 'https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets/edges2handbags.tar.gz'
-shoes_url = 'https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets/edges2shoes.tar.gz'
-maps_url = 'https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets/maps.tar.gz'
-cityscapes_url = 'https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets/cityscapes.tar.gz'
-facades_url = 'https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets/facades.tar.gz'
-
-wget.download(handbag_url)
-wget.download(shoes_url)
-wget.download(maps_url)
-wget.download(cityscapes_url)
-wget.download(facades_url)
-
-with tarfile.open('./edges2handbags.tar.gz') as tar:
-    tar.extractall()
-    tar.close()
-
-with tarfile.open('./edges2shoes.tar.gz') as tar:
-    tar.extractall()
-    tar.close()
-
-with tarfile.open('./maps.tar.gz') as tar:
-    tar.extractall()
-    tar.close()
-
-with tarfile.open('./cityscapes.tar.gz') as tar:
-    tar.extractall()
-    tar.close()
-
-with tarfile.open('./facades.tar.gz') as tar:
-    tar.extractall()
-    tar.close()
-
-os.remove('./edges2handbags.tar.gz')
-os.remove('./edges2shoes.tar.gz')
-os.remove('./maps.tar.gz')
-os.remove('./cityscapes.tar.gz')
-os.remove('./facades.tar.gz')
+PIX2PIX_URL = 'https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets'
+DATASETS = ['edges2handbags', 'edges2shoes', 'maps', 'cityscapes', 'facades']
+DONE_NAME = '.download_complete'
+
+
+class ResumableStream(object):
+    """Read-only file object over a URL or a local mirror file.
+
+    When the connection drops it reopens the source at the current offset with an HTTP range request, so the
+    tarfile reading from it never notices. The sha256 of all bytes read is updated on the way.
+    """
+    def __init__(self, source, retries=5, timeout=60, offset=0):
+        self.source = source
+        self.retries = retries
+        self.timeout = timeout
+        # offset > 0 continues a partial download, the sha256 of the bytes before it is updated by the caller
+        self.offset = offset
+        self.total = None
+        self.sha256 = hashlib.sha256()
+        self.fp = None
+        self._open()
+
+    def _open(self):
+        if self.fp is not None:
+            self.fp.close()
+
+        if not is_url(self.source):  # local mirror
+            self.fp = open(self.source, 'rb')
+            self.fp.seek(self.offset)
+            self.total = os.path.getsize(self.source)
+            return
+
+        headers = {'Range': 'bytes={}-'.format(self.offset)} if self.offset > 0 else {}
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(self.source, headers=headers),
+                                              timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or self.offset == 0:
+                raise
+            # range not satisfiable, nothing is left after the offset
+            self.fp, self.total = io.BytesIO(), self.offset
+            return
+        if self.offset > 0 and response.status != 206:
+            response.close()
+            raise IOError('{} does not support range requests, cannot resume'.format(self.source))
+        if response.getheader('Content-Length') is not None:
+            self.total = self.offset + int(response.getheader('Content-Length'))
+        self.fp = response
+
+    def read(self, size=-1):
+        for attempt in range(self.retries + 1):
+            try:
+                data = self.fp.read(size)
+                if size != 0 and len(data) == 0 and self.total is not None and self.offset < self.total:
+                    raise IOError('connection closed early')
+                break
+            except (IOError, socket.timeout, http.client.HTTPException) as e:
+                if attempt == self.retries:
+                    raise
+                print(' [!] {} at byte {}: {}, resuming'.format(self.source, self.offset, e))
+                self._open()
+
+        self.offset += len(data)
+        self.sha256.update(data)
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+def is_url(source):
+    return '://' in source
+
+
+def source_of(source, name):
+    if is_url(source):
+        return '{}/{}.tar.gz'.format(source.rstrip('/'), name)
+    return os.path.join(source, '{}.tar.gz'.format(name))
+
+
+def read_checksums(checksum_file):
+    # sha256sum format, "<sha256>  <name>.tar.gz" per line
+    checksums = {}
+    if checksum_file is not None:
+        with open(checksum_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    digest, filename = line.split()
+                    checksums[os.path.basename(filename)] = digest.lower()
+    return checksums
+
+
+def sidecar_checksum(archive):
+    # <name>.tar.gz.sha256 next to the archive on the mirror or the server, if there is one
+    try:
+        if not is_url(archive):
+            with open(archive + '.sha256', 'r') as f:
+                return f.read().split()[0].lower()
+        with urllib.request.urlopen(archive + '.sha256', timeout=60) as response:
+            return response.read().decode('utf-8').split()[0].lower()
+    except (IOError, urllib.error.URLError, IndexError):
+        return None
+
+
+def member_path(member, staging_dir):
+    # edges2shoes/train/1_AB.jpg to <staging_dir>/train/1_AB.jpg
+    parts = member.name.replace('\\', '/').split('/')[1:]
+    if len(parts) == 0 or os.path.isabs(member.name) or '..' in parts:
+        return None
+    return os.path.join(staging_dir, *parts)
+
+
+def verify(name, digest, expected):
+    if expected is None:
+        print(' [!] No checksum for {}, sha256 of the stream: {}'.format(name, digest))
+    elif digest != expected:
+        raise IOError('checksum mismatch for {}: expected {}, got {}'.format(name, expected, digest))
+
+
+def fetch_archive(name, source, out_dir, checksums):
+    # keep the archive as it is for the tar input pipeline of the Reader, e.g. <out_dir>/edges2shoes.tar.gz
+    path = os.path.join(out_dir, '{}.tar.gz'.format(name))
+    if os.path.isfile(path):
+        print(' [*] {} is already complete'.format(path))
+        return name
+
+    archive = source_of(source, name)
+    expected = checksums.get('{}.tar.gz'.format(name)) or sidecar_checksum(archive)
+
+    # an interrupted run leaves the .tmp file behind, continue after its last byte
+    tmp_path = path + '.tmp'
+    offset = os.path.getsize(tmp_path) if os.path.isfile(tmp_path) else 0
+    stream = ResumableStream(archive, offset=offset)
+    try:
+        if offset > 0:
+            print(' [*] {}: resuming at byte {}'.format(path, offset))
+            with open(tmp_path, 'rb') as f:
+                for data in iter(lambda: f.read(4*1024*1024), b''):
+                    stream.sha256.update(data)
+        with open(tmp_path, 'ab') as f:
+            shutil.copyfileobj(stream, f, length=4*1024*1024)
+    finally:
+        stream.close()
+
+    try:
+        verify(name, stream.sha256.hexdigest(), expected)
+    except IOError:
+        os.remove(tmp_path)  # the next run starts over instead of resuming a corrupt file
+        raise
+    os.rename(tmp_path, path)
+    print(' [*] {}: {} bytes'.format(path, stream.offset))
+    return name
+
+
+def fetch(name, source, out_dir, checksums):
+    final_dir = os.path.join(out_dir, name)
+    if os.path.isfile(os.path.join(final_dir, DONE_NAME)):
+        print(' [*] {} is already complete'.format(name))
+        return name
+
+    archive = source_of(source, name)
+    expected = checksums.get('{}.tar.gz'.format(name)) or sidecar_checksum(archive)
+
+    # members are extracted while the archive streams in, the archive itself never touches the disk. A previous
+    # interrupted run leaves the staging folder behind and its complete members are not written again.
+    staging_dir = os.path.join(out_dir, '.{}.partial'.format(name))
+    stream = ResumableStream(archive)
+    num_files, num_skipped = 0, 0
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            for member in tar:
+                path = member_path(member, staging_dir)
+                if path is None or not member.isfile():
+                    continue
+
+                num_files += 1
+                if os.path.isfile(path) and os.path.getsize(path) == member.size:
+                    num_skipped += 1
+                    continue
+
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path + '.tmp', 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(member), f)
+                os.rename(path + '.tmp', path)
+
+        # tarfile stops at the end-of-archive blocks, the rest of the stream (e.g. the gzip trailer) is part of the
+        # checksum as well
+        while stream.read(1 << 20):
+            pass
+    finally:
+        stream.close()
+
+    digest = stream.sha256.hexdigest()
+    try:
+        verify(name, digest, expected)
+    except IOError:
+        # the staged files came from a corrupt stream, the next run must not keep them
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    if not os.path.isdir(staging_dir):
+        raise IOError('no files found in {}'.format(archive))
+
+    # move train/ and val/ into the layout the Reader expects, e.g. <out_dir>/edges2shoes/train
+    if not os.path.isdir(final_dir):
+        os.makedirs(final_dir)
+    for split in os.listdir(staging_dir):
+        if os.path.exists(os.path.join(final_dir, split)):
+            shutil.rmtree(os.path.join(final_dir, split))
+        os.rename(os.path.join(staging_dir, split), os.path.join(final_dir, split))
+    os.rmdir(staging_dir)
+
+    with open(os.path.join(final_dir, DONE_NAME), 'w') as f:
+        f.write('{}  {}.tar.gz\n'.format(digest, name))
+
+    print(' [*] {}: {} files, {} kept from a previous run, {} bytes'.format(name, num_files, num_skipped,
+                                                                          stream.offset))
+    return name
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='download the pix2pix datasets into the Data folder')
+    parser.add_argument('--datasets', nargs='+', default=DATASETS, help='datasets to download, default: all')
+    parser.add_argument('--source', default=PIX2PIX_URL,
+                        help='base url or local mirror folder of the <name>.tar.gz archives, default: pix2pix server')
+    parser.add_argument('--out_dir', default='../../Data', help='output folder, default: ../../Data')
+    parser.add_argument('--workers', type=int, default=3, help='number of concurrent downloads, default: 3')
+    parser.add_argument('--checksum_file', default=None, help='sha256sum file of the archives, default: None')
+    parser.add_argument('--archive_only', action='store_true',
+                        help='keep the archives without extracting them, for --input_pipeline=tar')
+    flags = parser.parse_args(args)
+
+    checksums = read_checksums(flags.checksum_file)
+    if not os.path.isdir(flags.out_dir):
+        os.makedirs(flags.out_dir)
+
+    with ThreadPoolExecutor(max_workers=flags.workers) as executor:
+        fetcher = fetch_archive if flags.archive_only else fetch
+        futures = {name: executor.submit(fetcher, name, flags.source, flags.out_dir, checksums)
+                   for name in flags.datasets}
+
+    failed = []
+    for name, future in futures.items():
+        if future.exception() is not None:
+            print(' [!] {} failed: {}'.format(name, future.exception()))
+            failed.append(name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
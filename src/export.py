@@ -0,0 +1,95 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+
+from dataset import get_spec, image_size_of
+from discogan import Generator
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string('dataset', 'facades', 'dataset name from [edges2handbags, edges2shoes, handbags2shoes, maps, '
+                                             'cityscapes, facades], default: facades')
+tf.flags.DEFINE_integer('image_size', 0, 'resolution the model was trained for, 0 for the size of the dataset, '
+                                         'default: 0')
+tf.flags.DEFINE_string('load_model', None, 'folder of saved model that you wish to export, (e.g. 20180907-1739). '
+                                           'default: None')
+tf.flags.DEFINE_integer('num_batches', 50, 'number of timed single image runs, default: 50')
+
+
+def build_generators(spec, image_size, norm):
+    # A -> B and B -> A on placeholders of any batch size, inference mode
+    input_channel, output_channel = spec.channels
+    x_imgs = tf.placeholder(tf.float32, shape=[None, image_size[0], image_size[1], input_channel], name='A')
+    y_imgs = tf.placeholder(tf.float32, shape=[None, image_size[0], image_size[1], output_channel], name='B')
+
+    G_gen = Generator(name='G', ngf=64, norm=norm, output_channel=output_channel, _ops=[], image_size=image_size[0])
+    F_gen = Generator(name='F', ngf=64, norm=norm, output_channel=input_channel, _ops=[], image_size=image_size[0])
+    fake_y_imgs = tf.identity(G_gen(x_imgs, is_train=False), name='AB')
+    fake_x_imgs = tf.identity(F_gen(y_imgs, is_train=False), name='BA')
+
+    return [G_gen, F_gen], [x_imgs, y_imgs], [fake_y_imgs, fake_x_imgs]
+
+
+def time_single_image(sess, outputs, feed_dict, num_batches):
+    single_feed = {tfph: value[:1] for tfph, value in feed_dict.items()}
+    sess.run(outputs, feed_dict=single_feed)
+
+    start_time = time.time()
+    for _ in range(num_batches):
+        sess.run(outputs, feed_dict=single_feed)
+    return 1000. * (time.time() - start_time) / num_batches
+
+
+def main(_):
+    spec = get_spec(FLAGS.dataset)
+    image_size = image_size_of(spec, FLAGS.image_size)
+    model_dir = '{}/model/{}'.format(FLAGS.dataset, FLAGS.load_model)
+    export_dir = '{}/export/{}'.format(FLAGS.dataset, FLAGS.load_model)
+
+    ckpt = tf.train.get_checkpoint_state(model_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise IOError('no checkpoint found in {}'.format(model_dir))
+
+    test_imgs = [np.random.uniform(-1., 1., size=(8, image_size[0], image_size[1], channel))
+                 for channel in spec.channels]
+
+    # generators with the frozen batch norm, restored from the checkpoint
+    with tf.Graph().as_default(), tf.Session() as sess:
+        generators, inputs, outputs = build_generators(spec, image_size, norm='batch')
+        tf.train.Saver(tf.global_variables()).restore(sess, ckpt.model_checkpoint_path)
+        folded = [generator.folded_weights(sess) for generator in generators]
+
+        feed_dict = dict(zip(inputs, test_imgs))
+        expected = sess.run(outputs, feed_dict=feed_dict)
+        frozen_ms = time_single_image(sess, outputs, feed_dict, FLAGS.num_batches)
+
+    # generators without norm layers, the folded weights become constants of the exported graph
+    with tf.Graph().as_default() as graph, tf.Session() as sess:
+        generators, inputs, outputs = build_generators(spec, image_size, norm='none')
+        for generator, weights in zip(generators, folded):
+            for var in generator.variables:
+                var.load(weights[var.op.name[len(generator.name)+1:]], sess)
+
+        feed_dict = dict(zip(inputs, test_imgs))
+        results = sess.run(outputs, feed_dict=feed_dict)
+        folded_ms = time_single_image(sess, outputs, feed_dict, FLAGS.num_batches)
+
+        graph_def = graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), ['AB', 'BA'])
+        tf.train.write_graph(graph_def, export_dir, 'generators.pb', as_text=False)
+
+    print('[*] max abs difference of the folded generators: {:.2e}'.format(
+        max([np.max(np.abs(result - expect)) for result, expect in zip(results, expected)])))
+    print('[*] batch size 1, frozen batch norm: {:.2f} ms, folded: {:.2f} ms'.format(frozen_ms, folded_ms))
+    print('[*] Exported to {}, inputs: A, B, outputs: AB, BA'.format(os.path.join(export_dir, 'generators.pb')))
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,72 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+def cluster_hosts(num_ps, num_workers, base_port):
+    ps_hosts = ['localhost:{}'.format(base_port + idx) for idx in range(num_ps)]
+    worker_hosts = ['localhost:{}'.format(base_port + num_ps + idx) for idx in range(num_workers)]
+    return ps_hosts, worker_hosts
+
+
+def start_task(job_name, task_index, ps_hosts, worker_hosts, gpu_index, main_args, log_dir):
+    command = [sys.executable, 'main.py', '--job_name={}'.format(job_name), '--task_index={}'.format(task_index),
+               '--ps_hosts={}'.format(','.join(ps_hosts)), '--worker_hosts={}'.format(','.join(worker_hosts)),
+               '--gpu_index={}'.format(gpu_index)] + main_args
+    log_file = open(os.path.join(log_dir, '{}_{}.log'.format(job_name, task_index)), 'w')
+    print(' [*] {}:{} {}'.format(job_name, task_index, ' '.join(command)))
+    return subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT), log_file
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='run a distributed DiscoGAN training as localhost processes, the '
+                                                 'remaining arguments are passed to main.py of every task')
+    parser.add_argument('--num_ps', type=int, default=1, help='number of parameter servers, default: 1')
+    parser.add_argument('--num_workers', type=int, default=2, help='number of workers, worker 0 is the chief, '
+                                                                   'default: 2')
+    parser.add_argument('--base_port', type=int, default=2222, help='port of the first task, default: 2222')
+    parser.add_argument('--worker_gpus', default='',
+                        help='comma separated gpu index of every worker, cycled, empty for cpu only, default: ')
+    parser.add_argument('--log_dir', default='cluster_logs', help='output folder of the task logs, '
+                                                                  'default: cluster_logs')
+    flags, main_args = parser.parse_known_args(args)
+
+    if not os.path.isdir(flags.log_dir):
+        os.makedirs(flags.log_dir)
+    ps_hosts, worker_hosts = cluster_hosts(flags.num_ps, flags.num_workers, flags.base_port)
+    worker_gpus = flags.worker_gpus.split(',') if flags.worker_gpus else ['']
+
+    # parameter servers never use a gpu
+    ps_tasks = [start_task('ps', idx, ps_hosts, worker_hosts, '', main_args, flags.log_dir)
+                for idx in range(flags.num_ps)]
+    worker_tasks = [start_task('worker', idx, ps_hosts, worker_hosts, worker_gpus[idx % len(worker_gpus)],
+                               main_args, flags.log_dir) for idx in range(flags.num_workers)]
+
+    try:
+        while any([process.poll() is None for process, _ in worker_tasks]):
+            time.sleep(5)
+    finally:
+        # parameter servers serve forever, stop them once the workers are done or the launcher is interrupted
+        for process, _ in worker_tasks + ps_tasks:
+            if process.poll() is None:
+                process.terminate()
+        for process, log_file in worker_tasks + ps_tasks:
+            process.wait()
+            log_file.close()
+
+    failed = [idx for idx, (process, _) in enumerate(worker_tasks) if process.returncode != 0]
+    for idx in failed:
+        print(' [!] worker:{} failed, see {}'.format(idx, os.path.join(flags.log_dir, 'worker_{}.log'.format(idx))))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -6,32 +6,99 @@
 # ---------------------------------------------------------
 import os
 import tensorflow as tf
+
+import cpu_profile
 from solver import Solver
 
 FLAGS = tf.flags.FLAGS
 
 tf.flags.DEFINE_string('gpu_index', '0', 'gpu index if you have multiple gpus, default: 0')
+tf.flags.DEFINE_integer('num_towers', 1, 'number of data parallel towers that split every batch, default: 1')
+tf.flags.DEFINE_string('tower_device', 'gpu', 'device type of the towers from [gpu, cpu], cpu towers run on virtual '
+                                              'cpu devices, default: gpu')
+tf.flags.DEFINE_string('job_name', '', 'distributed training job from [ps, worker], empty for a single process, '
+                                       'default: ')
+tf.flags.DEFINE_integer('task_index', 0, 'task index of the job, worker 0 is the chief, default: 0')
+tf.flags.DEFINE_list('ps_hosts', '', 'comma separated host:port of the parameter servers, default: ')
+tf.flags.DEFINE_list('worker_hosts', '', 'comma separated host:port of the workers, default: ')
+tf.flags.DEFINE_string('cpu_profile', 'cpu_profiles.json', 'per host thread settings written by autotune.py, they '
+                                                        'fill the thread flags not given on the command line, empty '
+                                                        'to disable, default: cpu_profiles.json')
+tf.flags.DEFINE_integer('intra_op_threads', 0, 'threads of a single op, 0 for the tensorflow default, default: 0')
+tf.flags.DEFINE_integer('inter_op_threads', 0, 'threads running independent ops, 0 for the tensorflow default, '
+                                               'default: 0')
+tf.flags.DEFINE_integer('omp_threads', 0, 'OMP_NUM_THREADS of oneDNN (MKL) builds, 0 to keep the environment, '
+                                          'default: 0')
+tf.flags.DEFINE_integer('kmp_blocktime', -1, 'KMP_BLOCKTIME in ms of oneDNN (MKL) builds, -1 to keep the '
+                                             'environment, default: -1')
 tf.flags.DEFINE_integer('batch_size', 200, 'batch size, default: 200')
+tf.flags.DEFINE_integer('accum_steps', 1, 'number of micro-batches of batch_size whose gradients are accumulated '
+                                          'for one update, default: 1')
+tf.flags.DEFINE_bool('recompute', False, 'keep only the block outputs of the networks for the backward pass and '
+                                         'recompute the rest, less memory for more compute, default: False')
+tf.flags.DEFINE_bool('xla', False, 'compile the training step and the sampling graph with XLA, default: False')
+tf.flags.DEFINE_string('data_format', 'NHWC', 'layout of the conv layers from [NHWC, NCHW], NCHW needs a GPU or a '
+                                              'oneDNN (MKL) build of tensorflow on the cpu, default: NHWC')
 tf.flags.DEFINE_string('dataset', 'facades', 'dataset name from [edges2handbags, edges2shoes, handbags2shoes, maps, '
                                              'cityscapes, facades], default bag2shoes')
 tf.flags.DEFINE_bool('is_train', True, 'training or inference mode, default: True')
+tf.flags.DEFINE_integer('image_size', 0, 'target resolution of the networks, 4 times a power of 2, 0 for the size of '
+                                         'the dataset (64), default: 0')
+tf.flags.DEFINE_list('grow_sizes', '', 'comma separated smaller resolutions trained before image_size, increasing '
+                                       'powers of 2 from image_size / 4, e.g. 16,32 for 64 or 32,64 for 128, '
+                                       'default: ')
+tf.flags.DEFINE_float('grow_fraction', 0.7, 'fraction of the iterations trained at the grow_sizes, default: 0.7')
+tf.flags.DEFINE_bool('refresh_manifest', False, 'list the data folders again and update their file manifests, '
+                                                'not with the tar pipeline, default: False')
+tf.flags.DEFINE_string('input_pipeline', 'queue', 'input pipeline of the Reader from [queue, dataset, cache, '
+                                                  'tar], default: queue')
+tf.flags.DEFINE_bool('fast_decode', False, 'decode only the needed half of the image at a reduced DCT scale, '
+                                           'default: False')
+tf.flags.DEFINE_bool('batch_augment', False, 'random crop and flip whole batches instead of single images, '
+                                             'default: False')
+tf.flags.DEFINE_bool('shared_reader', False, 'decode each file once for both domains when they come from the same '
+                                             'folder, default: False')
+tf.flags.DEFINE_integer('num_threads', 8, 'number of reader threads, default: 8')
 
 tf.flags.DEFINE_float('learning_rate', 2e-4, 'initial learning rate for Adam, default: 0.0002')
 tf.flags.DEFINE_float('beta1', 0.5, 'beta1 momentum term of Adam, default: 0.5')
 tf.flags.DEFINE_float('beta2', 0.999, 'beta2 momentum term of Adam, default: 0.999')
 tf.flags.DEFINE_float('weight_decay', 1e-4, 'hyper-parameter for regularization term')
 
+tf.flags.DEFINE_integer('pool_size', 0, 'size of the generated image history for the discriminators, 0 to disable, '
+                                      'default: 0')
 tf.flags.DEFINE_integer('iters', 100000, 'number of iterations, default: 100000')
 tf.flags.DEFINE_integer('print_freq', 100, 'print frequency for loss, default: 100')
+tf.flags.DEFINE_integer('metrics_freq', 10, 'steps between the fetches of the losses and the summaries, default: 10')
+tf.flags.DEFINE_string('metrics_format', 'print', 'metrics output from [print, jsonl, csv], jsonl and csv write '
+                                                  'every fetched step to metrics.<format> of the logs folder and print '
+                                                  'one line, default: print')
+tf.flags.DEFINE_integer('metrics_queue', 100, 'records the background metrics writer can fall behind before they '
+                                              'are dropped, default: 100')
 tf.flags.DEFINE_integer('save_freq', 10000, 'save frequency for model, default: 10000')
+tf.flags.DEFINE_integer('keep_checkpoints', 5, 'number of the latest checkpoints to keep, default: 5')
+tf.flags.DEFINE_integer('keep_every', 0, 'keep the checkpoints of every keep_every iterations as well, 0 to disable, '
+                                         'default: 0')
+tf.flags.DEFINE_integer('keep_best', 0, 'keep the checkpoints with the lowest best_metric as well, default: 0')
+tf.flags.DEFINE_string('best_metric', 'cycle_loss', 'loss tracked between the checkpoints for keep_best, '
+                                                    'default: cycle_loss')
 tf.flags.DEFINE_integer('sample_freq', 500, 'sample frequency for saving image, default: 500')
 tf.flags.DEFINE_integer('sample_batch', 200, 'number of sampling images for check generator quality, default: 200')
+tf.flags.DEFINE_bool('val_stream', False, 'test over the whole val split with bounded memory, default: False')
+tf.flags.DEFINE_integer('val_memory_mb', 256, 'memory ceiling of the decoded val batches in MB, default: 256')
 tf.flags.DEFINE_string('load_model', None, 'folder of saved model taht you wish to continue training '
                        '(e.g. 20180907-1739), default: None')
 
 
 def main(_):
     os.environ['CUDA_VISIBLE_DEVICES'] = FLAGS.gpu_index
+    print(' [*] cpu profile: {}'.format(cpu_profile.resolve(FLAGS, FLAGS.cpu_profile)))
+
+    if FLAGS.job_name == 'ps':
+        # parameter servers only keep the variables, they serve until the launcher stops them
+        cluster = tf.train.ClusterSpec({'ps': FLAGS.ps_hosts, 'worker': FLAGS.worker_hosts})
+        tf.train.Server(cluster, job_name='ps', task_index=FLAGS.task_index).join()
+        return
 
     solver = Solver(FLAGS)
     if FLAGS.is_train:
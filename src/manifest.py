@@ -0,0 +1,98 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import json
+import hashlib
+import tempfile
+from PIL import Image
+
+
+def manifest_path(root):
+    # e.g. ../../Data/edges2shoes/train to ../../Data/edges2shoes/train.manifest.json
+    return root.rstrip('/') + '.manifest.json'
+
+
+class Manifest(object):
+    def __init__(self, root, entries, dir_mtime):
+        self.root = root
+        self.entries = entries
+        self.dir_mtime = dir_mtime
+
+    def __len__(self):
+        return len(self.entries)
+
+    def paths(self, extension=None):
+        return [os.path.join(self.root, entry['name']) for entry in self.entries
+                if extension is None or entry['name'].endswith(extension)]
+
+    def fingerprint(self, extension=None):
+        # names, sizes and modification times, changes whenever a file is added, removed or rewritten. The files are
+        # stat'ed again, the entries are not updated when a file is rewritten in place, the folder keeps its mtime
+        md5 = hashlib.md5()
+        for path in self.paths(extension):
+            stat = os.stat(path)
+            md5.update('{}:{}:{}\n'.format(os.path.basename(path), stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+        return md5.hexdigest()
+
+    def save(self):
+        # a temp file of its own, several workers of a cluster can write the manifest of the same folder at once
+        path = manifest_path(self.root)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'root': self.root, 'dir_mtime': self.dir_mtime, 'files': self.entries}, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def image_dims(path):
+    # PIL only parses the header here, the pixels are not decoded
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+        return height, width
+    except IOError:
+        return None, None
+
+
+def load(root, refresh=False):
+    """Returns the file manifest of root, listing the folder only when it changed.
+
+    The manifest is reused as long as the modification time of the folder is the same, i.e. no file was added or
+    removed. Otherwise, or with refresh=True, the folder is listed again and only new or rewritten files are
+    opened to read their image size.
+    """
+    dir_mtime = os.stat(root).st_mtime
+
+    cached = None
+    if os.path.isfile(manifest_path(root)):
+        with open(manifest_path(root), 'r') as f:
+            cached = json.load(f)
+
+        if not refresh and cached['dir_mtime'] == dir_mtime:
+            return Manifest(root, cached['files'], dir_mtime)
+
+    old_entries = {entry['name']: entry for entry in cached['files']} if cached is not None else {}
+    entries = []
+    for dir_entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if not dir_entry.is_file():
+            continue
+
+        stat = dir_entry.stat()
+        entry = old_entries.get(dir_entry.name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != int(stat.st_mtime):
+            height, width = image_dims(dir_entry.path)
+            entry = {'name': dir_entry.name, 'size': stat.st_size, 'mtime': int(stat.st_mtime),
+                     'height': height, 'width': width}
+        entries.append(entry)
+
+    manifest = Manifest(root, entries, dir_mtime)
+    manifest.save()
+    print(' [*] Manifest of {} updated, {} files'.format(root, len(entries)))
+    return manifest
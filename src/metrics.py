@@ -0,0 +1,98 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import csv
+import json
+import time
+import queue
+import threading
+import collections
+
+import utils as utils
+
+
+class MetricsWriter(object):
+    """Writes the summaries and the losses of the training loop on a background thread.
+
+    add never blocks the training thread, a record is dropped and counted when the bounded queue is full. The
+    summaries go to the FileWriter. With fmt='jsonl' or 'csv' the records of the training steps go to metrics.<fmt> in
+    log_dir and the other kinds of records to metrics_<kind>.<fmt>. The records added with echo=True go to echo_fn.
+    """
+    def __init__(self, summary_writer=None, log_dir=None, fmt='print', max_queue=100, echo_fn=utils.print_metrics):
+        if fmt not in ['print', 'jsonl', 'csv']:
+            raise ValueError('metrics format should be print, jsonl or csv, got {}'.format(fmt))
+
+        self.summary_writer = summary_writer
+        self.fmt = fmt
+        self.echo_fn = echo_fn
+        self.num_dropped = 0
+        self.log_dir = log_dir if fmt != 'print' else None
+        # kind: (file, csv writer), opened with the first record of the kind
+        self.files = {}
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, name='metrics_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, iter_time, metrics, summary=None, echo=False, kind='train'):
+        try:
+            self.queue.put_nowait((iter_time, metrics, summary, echo, kind))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            iter_time, metrics, summary, echo, kind = item
+            if self.summary_writer is not None and summary is not None:
+                self.summary_writer.add_summary(summary, iter_time)
+            if self.log_dir is not None:
+                self._write(iter_time, metrics, kind)
+            if echo:
+                self.echo_fn(iter_time, metrics)
+
+            # flush when the queue runs empty, not after every record of a burst
+            if self.queue.empty():
+                if self.summary_writer is not None:
+                    self.summary_writer.flush()
+                for fp, _ in self.files.values():
+                    fp.flush()
+
+    def _write(self, iter_time, metrics, kind):
+        record = collections.OrderedDict([('iter', iter_time), ('time', round(time.time(), 3))])
+        record.update([(name, float(value)) for name, value in metrics.items()])
+
+        if kind not in self.files:
+            name = 'metrics.{}' if kind == 'train' else 'metrics_' + kind + '.{}'
+            fp = open(os.path.join(self.log_dir, name.format(self.fmt)), 'a')
+            csv_writer = None
+            if self.fmt == 'csv':
+                csv_writer = csv.writer(fp)
+                if fp.tell() == 0:  # header of a new file
+                    csv_writer.writerow(list(record.keys()))
+            self.files[kind] = fp, csv_writer
+
+        fp, csv_writer = self.files[kind]
+        if csv_writer is None:
+            fp.write(json.dumps(record) + '\n')
+        else:
+            csv_writer.writerow(list(record.values()))
+
+    def close(self):
+        # waits for the queued records, the training loop is done by now
+        self.queue.put(None)
+        self.thread.join()
+        if self.summary_writer is not None:
+            self.summary_writer.flush()
+        for fp, _ in self.files.values():
+            fp.close()
+        if self.num_dropped > 0:
+            print(' [!] {} metrics records were dropped, the writer could not keep up'.format(self.num_dropped))
@@ -3,42 +3,186 @@
 # Licensed under The MIT License [see LICENSE for details]
 # Written by vanhuyz
 # ---------------------------------------------------------
+import os
+import re
+import tarfile
 import numpy as np
 import tensorflow as tf
 import time
 
+import manifest
+import shard_cache
+
 
 class Reader(object):
     def __init__(self, file_path, image_size=(64, 64, 3), min_queue_examples=100, batch_size=1, num_threads=8,
-                 side='left', ori_image_size=(256, 512, 3), name=None):
+                 side='left', ori_image_size=(256, 512, 3), pipeline='queue', prefetch=2, fast_decode=False,
+                 batch_augment=False, shard_index=0, num_shards=1, name=None):
         self.file_path = file_path
         self.image_size = image_size
         self.factor = 1.05
         # (256, 512, 3) to (256, 256, 3)
         self.ori_image_size = (ori_image_size[0], ori_image_size[0], ori_image_size[2])
-        self.bigger_size = [int(np.ceil(self.ori_image_size[0] * self.factor)),
-                            int(np.ceil(self.ori_image_size[1] * self.factor))]
+        self.fast_decode = fast_decode
+        # DCT-domain downscaling of libjpeg, only while the half image stays bigger than the input image size
+        self.ratio = self._decode_ratio() if self.fast_decode else 1
+        # (256, 256, 3) to (256/ratio, 256/ratio, 3)
+        self.decode_size = (int(np.ceil(self.ori_image_size[0] / self.ratio)),
+                            int(np.ceil(2 * self.ori_image_size[1] / self.ratio)) // 2, self.ori_image_size[2])
+        self.bigger_size = [int(np.ceil(self.decode_size[0] * self.factor)),
+                            int(np.ceil(self.decode_size[1] * self.factor))]
         self.min_queue_examples = min_queue_examples
         self.batch_size = batch_size
         self.num_threads = num_threads
         self.reader = tf.WholeFileReader()
         self.channel = self.image_size[2]
         self.side = side
+        self.pipeline = pipeline
+        self.batch_augment = batch_augment
+        self.prefetch = prefetch
+        # distributed workers read disjoint shards of the files
+        self.shard_index = shard_index
+        self.num_shards = num_shards
         self.name = name
 
     def feed(self):
+        if self.pipeline == 'queue':
+            return self._feed_queue()
+        elif self.pipeline == 'dataset' or self.pipeline == 'tar':
+            return self._feed_dataset()
+        elif self.pipeline == 'cache':
+            return self._feed_cache()
+        else:
+            raise NotImplementedError
+
+    def _feed_queue(self):
         with tf.name_scope(self.name):
-            filename_queue = tf.train.string_input_producer(tf.train.match_filenames_once(self.file_path+'/*.jpg'),
-                                                            capacity=2*self.min_queue_examples)
+            filename_queue = tf.train.string_input_producer(self._filenames(), capacity=2*self.min_queue_examples)
             _, serialized_example = self.reader.read(filename_queue)
-            image = tf.image.decode_jpeg(serialized_example, channels=self.channel)
-            image = self._preprocess(image)
+            image = self._parse(serialized_example)
             images = tf.train.shuffle_batch([image], batch_size=self.batch_size, num_threads=self.num_threads,
                                             capacity=self.min_queue_examples + 3 * self.batch_size,
                                             min_after_dequeue=self.min_queue_examples)
+            if self.batch_augment:
+                images = self._batch_augment(images)
+        return images
+
+    def _feed_dataset(self):
+        with tf.name_scope(self.name):
+            # file reads, decode and augmentation all run in the tf.data runtime, no queue runner threads needed
+            dataset = self._contents_dataset()
+            dataset = dataset.map(self._parse, num_parallel_calls=self.num_threads)
+            dataset = dataset.shuffle(buffer_size=self.min_queue_examples + 3 * self.batch_size)
+            dataset = dataset.batch(self.batch_size, drop_remainder=True)
+            if self.batch_augment:
+                dataset = dataset.map(self._batch_augment, num_parallel_calls=2)
+            dataset = dataset.prefetch(self.prefetch)
+
+            iterator = dataset.make_one_shot_iterator()
+            images = iterator.get_next()
         return images
 
-    def _preprocess(self, image):
+    def _feed_cache(self):
+        with tf.name_scope(self.name):
+            # uint8 shards written by build_cache.py, already split and resized to the working resolution
+            cache = shard_cache.ShardCache(shard_cache.cache_dir(
+                self.file_path, shard_cache.stored_size(self.image_size, self.factor)), side=self.side,
+                shard_index=self.shard_index, num_shards=self.num_shards)
+
+            def generator():
+                while True:
+                    yield cache.sample(self.batch_size, crop_size=self.image_size[:2])
+
+            dataset = tf.data.Dataset.from_generator(
+                generator, tf.uint8, tf.TensorShape([self.batch_size, self.image_size[0], self.image_size[1], 3]))
+            dataset = dataset.map(self._normalize, num_parallel_calls=2)
+            dataset = dataset.prefetch(self.prefetch)
+
+            iterator = dataset.make_one_shot_iterator()
+            images = iterator.get_next()
+        return images
+
+    def _filenames(self):
+        # file list of the persisted manifest instead of listing the folder at every launch
+        return manifest.load(self.file_path).paths(extension='.jpg')[self.shard_index::self.num_shards]
+
+    def _filename_dataset(self):
+        filenames = self._filenames()
+        dataset = tf.data.Dataset.from_tensor_slices(tf.constant(filenames))
+        dataset = dataset.shuffle(buffer_size=len(filenames))
+        return dataset.repeat()
+
+    def _archives(self):
+        # ../../Data/edges2shoes/train reads ../../Data/edges2shoes.tar, edges2shoes.tar.gz or shards like
+        # edges2shoes-00001.tar, not the archives of other names that start the same, e.g. edges2shoes_old.tar
+        data_dir = os.path.dirname(self.file_path.rstrip('/'))
+        parent, name = os.path.split(data_dir)
+        pattern = re.compile(re.escape(name) + r'(-[0-9]{5})?\.tar(\.gz)?$')
+        archives = sorted([os.path.join(parent, filename) for filename in os.listdir(parent or '.')
+                           if pattern.match(filename)]) if os.path.isdir(parent or '.') else []
+        if len(archives) == 0:
+            raise IOError('no tar archive found for {}'.format(data_dir))
+        return archives
+
+    def _contents_dataset(self):
+        if self.pipeline == 'dataset':
+            return self._filename_dataset().map(tf.read_file, num_parallel_calls=self.num_threads)
+        elif self.pipeline == 'tar':
+            archives = self._archives()
+            split = os.path.basename(self.file_path.rstrip('/'))
+            if len(archives) >= self.num_shards:
+                archives, member_shard = archives[self.shard_index::self.num_shards], (0, 1)
+            else:
+                # fewer archives than workers, every worker streams all of them and keeps its share of the members
+                member_shard = (self.shard_index, self.num_shards)
+
+            # every archive is read sequentially, the archives in parallel
+            dataset = tf.data.Dataset.from_tensor_slices(tf.constant(archives))
+            dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+                lambda archive: tf.data.Dataset.from_generator(
+                    tar_members, tf.string, tf.TensorShape([]), args=(archive, split) + member_shard),
+                cycle_length=len(archives), sloppy=True))
+            # members come in archive order, mix them before decoding
+            dataset = dataset.shuffle(buffer_size=self.min_queue_examples + 3 * self.batch_size)
+            return dataset.repeat()
+        else:
+            raise NotImplementedError
+
+    @staticmethod
+    def _normalize(images):
+        # uint8 [0, 255] to float32 [-1., 1.]
+        return tf.cast(images, dtype=tf.float32) / 127.5 - 1.
+
+    def _decode_ratio(self):
+        ratio = 1
+        while ratio < 8 and self.ori_image_size[0] / (2 * ratio) >= self.image_size[0]:
+            ratio *= 2
+        return ratio
+
+    def _parse(self, contents):
+        if self.fast_decode:
+            image = self._decode(contents)
+        else:
+            image = self._crop_side(tf.image.decode_jpeg(contents, channels=self.channel))
+
+        # with batch_augment the uint8 half image is batched first and augmented as a whole batch
+        return image if self.batch_augment else self._augment(image)
+
+    def _decode(self, contents):
+        # decode only the half of the side-by-side image selected by side, at 1/ratio of the original scale
+        if self.side == 'left':
+            offset_width = 0
+        elif self.side == 'right':
+            offset_width = self.decode_size[1]
+        else:
+            raise NotImplementedError
+
+        crop_window = tf.constant([0, offset_width, self.decode_size[0], self.decode_size[1]], dtype=tf.int32)
+        image = tf.image.decode_and_crop_jpeg(contents, crop_window, channels=self.channel, ratio=self.ratio)
+        image.set_shape([self.decode_size[0], self.decode_size[1], self.channel])
+        return image
+
+    def _crop_side(self, image):
         if self.side == 'left':
             print('self.ori_image_size: {}'.format(self.ori_image_size))
             image = tf.image.crop_to_bounding_box(image, offset_height=0, offset_width=0,
@@ -52,17 +196,122 @@ class Reader(object):
         else:
             raise NotImplementedError
 
+        image.set_shape(self.ori_image_size)
+        return image
+
+    def _augment(self, image, channel=None):
+        channel = self.channel if channel is None else channel
         random_seed = int(round(time.time()))
         # make image bigger
         image = tf.image.resize_images(image, size=(self.bigger_size[0], self.bigger_size[1]))
         # random crop
-        image = tf.random_crop(image, size=self.ori_image_size, seed=random_seed)
+        image = tf.random_crop(image, size=(self.decode_size[0], self.decode_size[1], channel), seed=random_seed)
         # random flip
         image = tf.image.random_flip_left_right(image, seed=random_seed)
         # resize to input image size
         image = tf.image.resize_images(image, size=(self.image_size[0], self.image_size[1]))
         # normalize to [-1., 1.]
         image = tf.image.convert_image_dtype(image, dtype=tf.float32) / 127.5 - 1.
-        image.set_shape(self.image_size)
+        image.set_shape((self.image_size[0], self.image_size[1], channel))
         return image
 
+    def _batch_augment(self, images):
+        """Same random crop and flip as _augment, but for a whole uint8 batch in one crop_and_resize op.
+
+        The 1.05 upscale followed by the random crop is a normalized box of decode_size / bigger_size at a uniform
+        offset, and a mirrored box (x1 > x2) samples the flipped crop.
+        """
+        batch_size = tf.shape(images)[0]
+        box_h = float(self.decode_size[0]) / self.bigger_size[0]
+        box_w = float(self.decode_size[1]) / self.bigger_size[1]
+
+        y1 = tf.random_uniform([batch_size], minval=0., maxval=1. - box_h)
+        x1 = tf.random_uniform([batch_size], minval=0., maxval=1. - box_w)
+        y2, x2 = y1 + box_h, x1 + box_w
+
+        # random flip
+        flip_mask = tf.random_uniform([batch_size]) < 0.5
+        x1, x2 = tf.where(flip_mask, x2, x1), tf.where(flip_mask, x1, x2)
+
+        boxes = tf.stack([y1, x1, y2, x2], axis=1)
+        images = tf.image.crop_and_resize(tf.cast(images, dtype=tf.float32), boxes, tf.range(batch_size),
+                                          crop_size=(self.image_size[0], self.image_size[1]))
+        # normalize to [-1., 1.]
+        images = images / 127.5 - 1.
+        images.set_shape([None, self.image_size[0], self.image_size[1], images.get_shape()[-1]])
+        return images
+
+
+class PairReader(Reader):
+    """Reads and decodes every side-by-side file once for both domains.
+
+    The left and right halves go to two independent shuffle queues, so the two batches returned by feed stay
+    unpaired although they come from the same files.
+    """
+    def __init__(self, file_path, left_channel=3, **kwargs):
+        super(PairReader, self).__init__(file_path, **kwargs)
+        self.left_channel = left_channel
+
+    def feed(self):
+        with tf.name_scope(self.name):
+            left, right = self._pair_source()
+            left_imgs, right_imgs = self._unpaired_batches(left, right)
+        return left_imgs, right_imgs
+
+    def _pair_source(self):
+        if self.pipeline == 'queue':
+            filename_queue = tf.train.string_input_producer(self._filenames(), capacity=2*self.min_queue_examples)
+            _, serialized_example = self.reader.read(filename_queue)
+            return self._parse_pair(serialized_example)
+        elif self.pipeline == 'dataset' or self.pipeline == 'tar':
+            dataset = self._contents_dataset()
+            dataset = dataset.map(self._parse_pair, num_parallel_calls=self.num_threads)
+            dataset = dataset.prefetch(self.batch_size)
+            return dataset.make_one_shot_iterator().get_next()
+        else:
+            # the cache pipeline already stores the two halves separately
+            raise NotImplementedError
+
+    def _parse_pair(self, contents):
+        image = tf.image.decode_jpeg(contents, channels=self.channel, ratio=self.ratio)
+        left = tf.image.crop_to_bounding_box(image, offset_height=0, offset_width=0,
+                                             target_height=self.decode_size[0], target_width=self.decode_size[1])
+        right = tf.image.crop_to_bounding_box(image, offset_height=0, offset_width=self.decode_size[1],
+                                              target_height=self.decode_size[0], target_width=self.decode_size[1])
+        if self.left_channel == 1:
+            # gray scale input, keep only the channel that DiscoGAN used to split out after batching
+            left = left[:, :, 1:2]
+
+        if self.batch_augment:
+            return left, right
+        return self._augment(left, channel=self.left_channel), self._augment(right)
+
+    def _unpaired_batches(self, left, right):
+        capacity = self.min_queue_examples + 3 * self.batch_size
+        queues = [tf.RandomShuffleQueue(capacity, self.min_queue_examples, dtypes=[img.dtype],
+                                        shapes=[img.get_shape()], name='{}_shuffle_queue'.format(side))
+                  for img, side in zip([left, right], ['left', 'right'])]
+
+        # one decode feeds both queues
+        enqueue_op = tf.group(queues[0].enqueue(left), queues[1].enqueue(right))
+        close_op = tf.group(*[queue.close() for queue in queues])
+        cancel_op = tf.group(*[queue.close(cancel_pending_enqueues=True) for queue in queues])
+        tf.train.add_queue_runner(tf.train.QueueRunner(queues[0], [enqueue_op] * self.num_threads,
+                                                       close_op=close_op, cancel_op=cancel_op))
+
+        batches = [queue.dequeue_many(self.batch_size) for queue in queues]
+        if self.batch_augment:
+            batches = [self._batch_augment(batch) for batch in batches]
+        return batches
+
+
+def tar_members(archive, split, shard_index=0, num_shards=1, bufsize=4*1024*1024):
+    # contents of the jpg members under <split>/ of a (gzipped) tar archive, read as one sequential stream
+    archive, split = archive.decode('utf-8'), split.decode('utf-8')
+    with tarfile.open(archive, mode='r|*', bufsize=bufsize) as tar:
+        num_members = 0
+        for member in tar:
+            if member.isfile() and member.name.endswith('.jpg') and split in member.name.split('/')[:-1]:
+                if np.mod(num_members, num_shards) == shard_index:
+                    yield tar.extractfile(member).read()
+                num_members += 1
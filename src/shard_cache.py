@@ -0,0 +1,99 @@
+# ---------------------------------------------------------
+# Tensorflow DiscoGAN Implementation
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Cheng-Bin Jin
+# Email: sbkim0407@gmail.com
+# ---------------------------------------------------------
+import os
+import json
+import numpy as np
+import cv2
+
+import manifest
+
+INDEX_NAME = 'index.json'
+
+
+def stored_size(image_size, factor=1.05):
+    # working resolution with headroom for the random crop, e.g. (64, 64) -> (68, 68)
+    return int(np.ceil(image_size[0] * factor)), int(np.ceil(image_size[1] * factor))
+
+
+def cache_dir(file_path, size):
+    return '{}_cache_{}x{}'.format(file_path.rstrip('/'), size[0], size[1])
+
+
+def split_pair(img):
+    # pix2pix side-by-side image (H, 2W, C) to left and right halves (H, W, C)
+    w_single = int(img.shape[1] / 2)
+    return {'left': img[:, :w_single], 'right': img[:, w_single:2*w_single]}
+
+
+def build(file_path, size, sides=('left', 'right'), shard_size=4096, out_dir=None):
+    out_dir = cache_dir(file_path, size) if out_dir is None else out_dir
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    filenames = manifest.load(file_path).paths(extension='.jpg')
+    num_shards = int(np.ceil(len(filenames) / shard_size))
+    shards = []
+
+    for shard_idx in range(num_shards):
+        names = filenames[shard_idx*shard_size:(shard_idx+1)*shard_size]
+        arrs = {side: np.lib.format.open_memmap(
+            os.path.join(out_dir, '{}_{:05d}.npy'.format(side, shard_idx)), mode='w+', dtype=np.uint8,
+            shape=(len(names), size[0], size[1], 3)) for side in sides}
+
+        for idx, name in enumerate(names):
+            img = cv2.cvtColor(cv2.imread(name, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+            halves = split_pair(img)
+            for side in sides:
+                # cv2.resize takes dsize as (width, height)
+                arrs[side][idx] = cv2.resize(halves[side], dsize=(size[1], size[0]), interpolation=cv2.INTER_AREA)
+
+        for arr in arrs.values():
+            arr.flush()
+        shards.append({'index': shard_idx, 'count': len(names)})
+        print('[*] shard {}/{} done'.format(shard_idx + 1, num_shards))
+
+    index = {'source': os.path.abspath(file_path), 'size': list(size), 'sides': list(sides),
+             'num_images': len(filenames), 'shards': shards, 'files': [os.path.basename(name) for name in filenames]}
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+
+    return out_dir
+
+
+class ShardCache(object):
+    def __init__(self, out_dir, side, shard_index=0, num_shards=1):
+        with open(os.path.join(out_dir, INDEX_NAME), 'r') as f:
+            self.index = json.load(f)
+
+        if side not in self.index['sides']:
+            raise ValueError('side {} is not stored in {}'.format(side, out_dir))
+
+        self.size = tuple(self.index['size'])
+        self.shards = [np.load(os.path.join(out_dir, '{}_{:05d}.npy'.format(side, shard['index'])), mmap_mode='r')
+                       for shard in self.index['shards']]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.num_images = int(self.offsets[-1])
+        # distributed workers sample from disjoint images, every num_shards-th one from shard_index
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+
+    def sample(self, batch_size, crop_size, flip=True):
+        num_shard_images = int(np.ceil((self.num_images - self.shard_index) / self.num_shards))
+        ids = np.sort(self.shard_index + self.num_shards * np.random.randint(0, num_shard_images, size=batch_size))
+        shard_ids = np.searchsorted(self.offsets, ids, side='right') - 1
+
+        h1 = np.random.randint(0, self.size[0] - crop_size[0] + 1, size=batch_size)
+        w1 = np.random.randint(0, self.size[1] - crop_size[1] + 1, size=batch_size)
+        flips = np.random.random(batch_size) > 0.5 if flip else np.zeros(batch_size, dtype=bool)
+
+        batch = np.empty((batch_size, crop_size[0], crop_size[1], 3), dtype=np.uint8)
+        for idx in range(batch_size):
+            img = self.shards[shard_ids[idx]][ids[idx] - self.offsets[shard_ids[idx]]]
+            batch[idx] = img[h1[idx]:h1[idx]+crop_size[0], w1[idx]:w1[idx]+crop_size[1]]
+        batch[flips] = batch[flips, :, ::-1]
+
+        return batch
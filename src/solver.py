@@ -5,35 +5,162 @@
 # Email: sbkim0407@gmail.com
 # ---------------------------------------------------------
 import os
+import math
+import shutil
+import tempfile
+import collections
 import numpy as np
 import tensorflow as tf
 from datetime import datetime
 
+import manifest
+import cpu_profile
+from metrics import MetricsWriter
+from checkpointer import AsyncCheckpointer
 # noinspection PyPep8Naming
 from dataset import Dataset
-from discogan import DiscoGAN
+from discogan import DiscoGAN, LOSS_NAMES, grow_sizes_of
 
 
 class Solver(object):
     def __init__(self, flags):
         run_config = tf.ConfigProto()
         run_config.gpu_options.allow_growth = True
-        self.sess = tf.Session(config=run_config)
+        cpu_profile.configure(flags, run_config)
+        if flags.num_towers > 1:
+            run_config.allow_soft_placement = True
+            if flags.tower_device == 'cpu':
+                # virtual cpu devices, one for each tower
+                run_config.device_count['CPU'] = flags.num_towers
 
         self.flags = flags
+        self.run_config = run_config
+        self.distributed = self.flags.job_name == 'worker'
+        self.is_chief = not self.distributed or self.flags.task_index == 0
+        self.num_workers = len(self.flags.worker_hosts) if self.distributed else 1
+
         self.dataset = Dataset(self.flags.dataset, self.flags)
-        self.model = DiscoGAN(self.sess, self.flags, self.dataset.image_size, self.dataset.ori_image_size,
-                              self.dataset())
+        # the val split streams from the disk with val_stream
+        self.data_path = self.dataset(load_val=not self.flags.val_stream)
+        # the tar pipeline reads the archives, there may be no extracted folder to list
+        if self.flags.refresh_manifest and self.flags.input_pipeline != 'tar':
+            for path in set(self.data_path):
+                manifest.load(path, refresh=True)
 
-        self._make_folders()
+        # distributed workers share the iterations, the learning rate follows the updates of all the workers
+        self.num_iters = int(math.ceil(self.flags.iters / self.num_workers))
+        self.stages = self._stages()
         self.iter_time = 0
 
+        if self.distributed:
+            if len(self.stages) > 1:
+                raise NotImplementedError('progressive training is not supported in distributed training')
+            self._build_distributed(run_config, self.data_path)
+            # every op is built by now, adding one later raises instead of growing the graph silently
+            self.sess.graph.finalize()
+        else:
+            self._build_model(self._stage_size(self._resume_iter()))
+
+        self._make_folders()
+
+        # tf_utils.show_all_variables()
+
+    def _stages(self):
+        # [(image size, end iteration)], the smaller grow_sizes share grow_fraction of the iterations and the rest is
+        # trained at the target size
+        target = self.dataset.image_size[0]
+        sizes = grow_sizes_of(self.flags.grow_sizes, target) if self.flags.is_train else []
+        stage_iters = int(self.num_iters * self.flags.grow_fraction / len(sizes)) if len(sizes) > 0 else 0
+        stages = [(size, (idx + 1) * stage_iters) for idx, size in enumerate(sizes)]
+        return stages + [(target, self.num_iters)]
+
+    def _stage_size(self, iter_time):
+        for size, end_iter in self.stages:
+            if iter_time < end_iter:
+                return size
+        return self.stages[-1][0]
+
+    def _resume_iter(self):
+        # iteration of the checkpoint to continue from, the graph is built at the size of its stage
+        if not self.flags.is_train or self.flags.load_model is None:
+            return 0
+        ckpt = tf.train.get_checkpoint_state('{}/model/{}'.format(self.flags.dataset, self.flags.load_model))
+        if ckpt and ckpt.model_checkpoint_path:
+            return int(ckpt.model_checkpoint_path.split('-')[-1])
+        return 0
+
+    def _build_model(self, size):
+        image_size = (size, size, self.dataset.image_size[2])
+        self.sess = tf.Session(config=self.run_config)
+        self.model = DiscoGAN(self.sess, self.flags, image_size, self.dataset.ori_image_size, self.data_path,
+                              target_size=self.dataset.image_size[0])
+
         self.saver = tf.train.Saver()
+        # the image pools hold images of the stage size, they start empty at the next size
+        self.grow_saver = tf.train.Saver(
+            var_list=[var for var in tf.global_variables() if var not in self.model.pool_variables])
         self.sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        # every op is built by now, adding one later raises instead of growing the graph silently
+        self.sess.graph.finalize()
 
-        # tf_utils.show_all_variables()
+    def _grow(self, size):
+        # the networks are fully convolutional with the depth of the target size, so the same variables continue at
+        # the next size in a new graph. The handover goes through a temporary folder, the checkpoints of the run
+        # stay the ones of the retention
+        grow_dir = tempfile.mkdtemp(prefix='grow_')
+        try:
+            path = self.grow_saver.save(self.sess, os.path.join(grow_dir, 'grow'), global_step=self.iter_time,
+                                        write_meta_graph=False)
+            self.sess.close()
+            tf.reset_default_graph()
+
+            self._build_model(size)
+            self.grow_saver.restore(self.sess, path)
+        finally:
+            shutil.rmtree(grow_dir, ignore_errors=True)
+        print(' [*] Grow to {}x{} at iter_time: {}'.format(size, size, self.iter_time))
+
+    def _build_distributed(self, run_config, data_path):
+        if self.flags.num_towers > 1:
+            raise NotImplementedError('towers inside a distributed worker are not supported')
+
+        cluster = tf.train.ClusterSpec({'ps': self.flags.ps_hosts, 'worker': self.flags.worker_hosts})
+        self.server = tf.train.Server(cluster, job_name='worker', task_index=self.flags.task_index, config=run_config)
+        worker_device = '/job:worker/task:{}'.format(self.flags.task_index)
+
+        # variables on the parameter servers, every worker reads its own shard of the files
+        with tf.device(tf.train.replica_device_setter(worker_device=worker_device, cluster=cluster)):
+            self.model = DiscoGAN(None, self.flags, self.dataset.image_size, self.dataset.ori_image_size, data_path,
+                                  shard_index=self.flags.task_index, num_shards=self.num_workers,
+                                  local_device=worker_device)
+        self.saver = tf.train.Saver()
+
+        # the chief restores or initializes the shared variables inside the session creation, so the other workers
+        # that wait for them to be ready never start from the initial values of a resumed run
+        session_manager = tf.train.SessionManager(
+            local_init_op=tf.local_variables_initializer(),
+            ready_op=tf.report_uninitialized_variables(tf.global_variables()))
+        if self.is_chief:
+            checkpoint_dir = None
+            if self.flags.load_model is not None:
+                checkpoint_dir = '{}/model/{}'.format(self.flags.dataset, self.flags.load_model)
+            self.sess = session_manager.prepare_session(self.server.target, init_op=tf.global_variables_initializer(),
+                                                        saver=self.saver, checkpoint_dir=checkpoint_dir,
+                                                        config=run_config)
+        else:
+            self.sess = session_manager.wait_for_session(self.server.target, config=run_config)
+        self.model.sess = self.sess
+
+        # every train_step of every worker is one update, the workers continue from their share of the updates
+        self.iter_time = int(self.sess.run(self.model.global_steps[0])) // self.num_workers
+        if self.iter_time > 0:
+            print('[*] Load iter_time: {}'.format(self.iter_time))
 
     def _make_folders(self):
+        if self.flags.is_train and not self.is_chief:  # distributed worker, only the chief writes to the disk
+            self.metrics_writer = MetricsWriter(max_queue=self.flags.metrics_queue, echo_fn=self._print_info)
+            return
+
         if self.flags.is_train:  # train stage
             if self.flags.load_model is None:
                 cur_time = datetime.now().strftime("%Y%m%d-%H%M")
@@ -48,8 +175,19 @@ class Solver(object):
             if not os.path.isdir(self.sample_out_dir):
                 os.makedirs(self.sample_out_dir)
 
-            self.train_writer = tf.summary.FileWriter("{}/logs/{}".format(self.flags.dataset, cur_time),
-                                                      graph_def=self.sess.graph_def)
+            log_dir = "{}/logs/{}".format(self.flags.dataset, cur_time)
+            self.train_writer = tf.summary.FileWriter(log_dir, graph_def=self.sess.graph_def)
+            # summaries, metrics file and console output are written on a background thread
+            self.metrics_writer = MetricsWriter(self.train_writer, log_dir, fmt=self.flags.metrics_format,
+                                                max_queue=self.flags.metrics_queue, echo_fn=self._print_info)
+
+            # checkpoints are written on a background thread, the retention replaces max_to_keep of the Saver
+            if self.flags.best_metric not in LOSS_NAMES:
+                raise ValueError('best_metric should be one of {}, got {}'.format(LOSS_NAMES, self.flags.best_metric))
+            self.checkpointer = AsyncCheckpointer(self.model_out_dir, keep_last=self.flags.keep_checkpoints,
+                                                  keep_every=self.flags.keep_every, keep_best=self.flags.keep_best,
+                                                  on_saved=self._on_saved)
+            self.tracked_metric = []
 
         elif not self.flags.is_train:  # test stage
             self.model_out_dir = "{}/model/{}".format(self.flags.dataset, self.flags.load_model)
@@ -58,49 +196,80 @@ class Solver(object):
                 os.makedirs(self.test_out_dir)
 
     def train(self):
-        # load initialized checkpoint that provided
-        if self.flags.load_model is not None:
+        # load initialized checkpoint that provided, distributed workers are restored with their session
+        if self.flags.load_model is not None and not self.distributed:
             if self.load_model():
                 print(' [*] Load SUCCESS!\n')
             else:
                 print(' [!] Load Failed...\n')
 
+        try:
+            for stage_idx, (size, end_iter) in enumerate(self.stages):
+                if self.iter_time >= end_iter:
+                    continue  # resumed after this stage
+
+                if size != self.model.image_size[0]:
+                    self._grow(size)
+                if not self._train_stage(end_iter, is_last=stage_idx == len(self.stages) - 1):
+                    break
+        finally:
+            # also when a step raised, the writers are daemon threads and would lose the queued work at exit
+            try:
+                if self.is_chief:
+                    self.checkpointer.close()
+            finally:
+                self.metrics_writer.close()
+
+    def _print_info(self, iter_time, metrics):
+        # the model of the current stage
+        self.model.print_info(metrics, iter_time)
+
+    def _train_stage(self, end_iter, is_last=True):
         # threads for tfrecord
         coord = tf.train.Coordinator()
         threads = tf.train.start_queue_runners(sess=self.sess, coord=coord)
 
         try:
             # for iter_time in range(self.flags.iters):
-            while self.iter_time < self.flags.iters:
-                # samppling images and save them
-                self.sample(self.iter_time)
-
-                # train_step
-                loss, summary = self.model.train_step()
-                self.model.print_info(loss, self.iter_time)
-                self.train_writer.add_summary(summary, self.iter_time)
-                self.train_writer.flush()
-
-                # save model
-                self.save_model(self.iter_time)
+            while self.iter_time < end_iter:
+                # samppling images and save them, summaries and checkpoints only on the chief
+                if self.is_chief:
+                    self.sample(self.iter_time)
+
+                # train_step, the losses and summaries are fetched only every metrics_freq and print_freq steps
+                is_print = np.mod(self.iter_time, self.flags.print_freq) == 0
+                loss, summary = self.model.train_step(
+                    fetch_metrics=is_print or np.mod(self.iter_time, self.flags.metrics_freq) == 0)
+                if loss is not None:
+                    metrics = self.model.metrics(loss)
+                    self.metrics_writer.add(self.iter_time, metrics, summary, echo=is_print)
+                    if self.is_chief:
+                        self.tracked_metric.append(metrics[self.flags.best_metric])
+
+                if self.is_chief:
+                    # save model
+                    self.save_model(self.iter_time)
                 self.iter_time += 1
 
-            # infinitely generate
-            imgs, names = self.model.test_infinitely(input_type='A', count=5)
-            self.model.plots(imgs, self.iter_time, self.sample_out_dir, names)
+            if self.is_chief and is_last:
+                # infinitely generate
+                imgs, names = self.model.test_infinitely(input_type='A', count=5)
+                self.model.plots(imgs, self.iter_time, self.sample_out_dir, names)
 
-            imgs, names = self.model.test_infinitely(input_type='B', count=5)
-            self.model.plots(imgs, self.iter_time, self.sample_out_dir, names)
+                imgs, names = self.model.test_infinitely(input_type='B', count=5)
+                self.model.plots(imgs, self.iter_time, self.sample_out_dir, names)
 
-            self.save_model(self.flags.iters)
+                self.save_model(self.flags.iters)
         except KeyboardInterrupt:
             coord.request_stop()
+            return False
         except Exception as e:
             coord.request_stop(e)
         finally:
             # when done, ask the threads to stop
             coord.request_stop()
             coord.join(threads)
+        return True
 
     def test(self):
         if self.load_model():
@@ -113,6 +282,10 @@ class Solver(object):
         threads = tf.train.start_queue_runners(sess=self.sess, coord=coord)
 
         try:
+            if self.flags.val_stream:
+                self.test_val_stream()
+                return
+
             num_iters = 20
             for iter_time in range(num_iters):
                 print('iter_time: {}'.format(iter_time))
@@ -132,6 +305,15 @@ class Solver(object):
             coord.request_stop()
             coord.join(threads)
 
+    def test_val_stream(self):
+        # whole val split in sample_batch sized batches, memory stays flat with the split size
+        val_stream = self.dataset.val_stream(self.flags.sample_batch, max_memory_mb=self.flags.val_memory_mb)
+        for iter_time, (x_imgs, y_imgs) in enumerate(val_stream):
+            print('iter_time: {} / {}'.format(iter_time, len(val_stream)))
+
+            imgs, names = self.model.test_step(x_imgs, y_imgs)
+            self.model.plots(imgs, iter_time, self.test_out_dir, names)
+
     def sample(self, iter_time):
         if np.mod(iter_time, self.flags.sample_freq) == 0:
             imgs, names = self.model.sample_imgs()
@@ -139,9 +321,18 @@ class Solver(object):
 
     def save_model(self, iter_time):
         if np.mod(iter_time + 1, self.flags.save_freq) == 0:
-            model_name = 'model'
-            self.saver.save(self.sess, os.path.join(self.model_out_dir, model_name), global_step=iter_time)
-            print('[*] Model saved!')
+            # mean of the tracked metric over the steps since the last checkpoint, for the keep_best retention
+            metric = float(np.mean(self.tracked_metric)) if len(self.tracked_metric) > 0 else None
+            self.tracked_metric = []
+            self.checkpointer.save(self.sess, iter_time, metric=metric)
+
+    def _on_saved(self, step, path, stall_ms, save_ms):
+        # on the background thread of the checkpointer
+        print('[*] Model saved! {}, training stall: {:.1f} ms, save: {:.1f} ms'.format(path, stall_ms, save_ms))
+        summary = tf.Summary(value=[tf.Summary.Value(tag='checkpoint/stall_ms', simple_value=stall_ms),
+                                    tf.Summary.Value(tag='checkpoint/save_ms', simple_value=save_ms)])
+        self.metrics_writer.add(step, collections.OrderedDict([('stall_ms', stall_ms), ('save_ms', save_ms)]),
+                                summary, kind='checkpoint')
 
     def load_model(self):
         print(' [*] Reading checkpoint...')
@@ -4,25 +4,61 @@
 # Written by Cheng-Bin Jin
 # Email: sbkim0407@gmail.com
 # ---------------------------------------------------------
+import contextlib
+import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 from tensorflow.python.training import moving_averages
 
 
+def channel_axis(data_format='NHWC'):
+    if data_format not in ['NHWC', 'NCHW']:
+        raise ValueError('data_format should be NHWC or NCHW, got {}'.format(data_format))
+    return 1 if data_format == 'NCHW' else 3
+
+
+def spatial_axes(data_format='NHWC'):
+    return [2, 3] if channel_axis(data_format) == 1 else [1, 2]
+
+
+def strides(d_h, d_w, data_format='NHWC'):
+    return [1, 1, d_h, d_w] if channel_axis(data_format) == 1 else [1, d_h, d_w, 1]
+
+
+def broadcast_channels(x, data_format='NHWC'):
+    # per channel parameters of shape [C] against the activations
+    return tf.reshape(x, [1, -1, 1, 1]) if channel_axis(data_format) == 1 else x
+
+
+def to_data_format(x, data_format='NHWC', name='to_data_format'):
+    # NHWC images of the input pipeline to the layout of the layers
+    if channel_axis(data_format) == 3:
+        return x
+    return tf.transpose(x, [0, 3, 1, 2], name=name)
+
+
+def from_data_format(x, data_format='NHWC', name='from_data_format'):
+    # back to NHWC images for the host
+    if channel_axis(data_format) == 3:
+        return x
+    return tf.transpose(x, [0, 2, 3, 1], name=name)
+
+
 def padding2d(x, p_h=1, p_w=1, pad_type='REFLECT', name='pad2d'):
     if pad_type == 'REFLECT':
         return tf.pad(x, [[0, 0], [p_h, p_h], [p_w, p_w], [0, 0]], 'REFLECT', name=name)
 
 
-def conv2d(x, output_dim, k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02, padding='SAME', name='conv2d', is_print=True):
+def conv2d(x, output_dim, k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02, padding='SAME', name='conv2d', is_print=True,
+           data_format='NHWC'):
     with tf.variable_scope(name):
-        w = tf.get_variable('w', [k_h, k_w, x.get_shape()[-1], output_dim],
+        w = tf.get_variable('w', [k_h, k_w, x.get_shape()[channel_axis(data_format)], output_dim],
                             initializer=tf.truncated_normal_initializer(stddev=stddev))
-        conv = tf.nn.conv2d(x, w, strides=[1, d_h, d_w, 1], padding=padding)
+        conv = tf.nn.conv2d(x, w, strides=strides(d_h, d_w, data_format), padding=padding, data_format=data_format)
 
         biases = tf.get_variable('biases', [output_dim], initializer=tf.constant_initializer(0.0))
         # conv = tf.reshape(tf.nn.bias_add(conv, biases), conv.get_shape())
-        conv = tf.nn.bias_add(conv, biases)
+        conv = tf.nn.bias_add(conv, biases, data_format=data_format)
 
         if is_print:
             print_activations(conv)
@@ -31,25 +67,29 @@ def conv2d(x, output_dim, k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02, padding='SAME
 
 
 def deconv2d(x, k, k_h=3, k_w=3, d_h=2, d_w=2, stddev=0.02, padding_='SAME', output_size=None,
-             name='deconv2d', with_w=False, is_print=True):
+             name='deconv2d', with_w=False, is_print=True, data_format='NHWC'):
     with tf.variable_scope(name):
         input_shape = x.get_shape().as_list()
+        h_axis, w_axis = spatial_axes(data_format)
 
         # calculate output size
         h_output, w_output = None, None
         if not output_size:
-            h_output, w_output = input_shape[1] * 2, input_shape[2] * 2
+            h_output, w_output = input_shape[h_axis] * 2, input_shape[w_axis] * 2
         # output_shape = [input_shape[0], h_output, w_output, k]  # error when not define batch_size
-        output_shape = [tf.shape(x)[0], h_output, w_output, k]
+        if data_format == 'NCHW':
+            output_shape = [tf.shape(x)[0], k, h_output, w_output]
+        else:
+            output_shape = [tf.shape(x)[0], h_output, w_output, k]
 
         # conv2d transpose
-        w = tf.get_variable('w', [k_h, k_w, k, input_shape[3]],
+        w = tf.get_variable('w', [k_h, k_w, k, input_shape[channel_axis(data_format)]],
                             initializer=tf.random_normal_initializer(stddev=stddev))
-        deconv = tf.nn.conv2d_transpose(x, w, output_shape=output_shape, strides=[1, d_h, d_w, 1],
-                                        padding=padding_)
+        deconv = tf.nn.conv2d_transpose(x, w, output_shape=output_shape, strides=strides(d_h, d_w, data_format),
+                                        padding=padding_, data_format=data_format)
 
-        biases = tf.get_variable('biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
-        deconv = tf.nn.bias_add(deconv, biases)
+        biases = tf.get_variable('biases', [k], initializer=tf.constant_initializer(0.0))
+        deconv = tf.nn.bias_add(deconv, biases, data_format=data_format)
 
         if is_print:
             print_activations(deconv)
@@ -80,19 +120,26 @@ def linear(x, output_size, bias_start=0.0, with_w=False, name='fc'):
             return tf.matmul(x, matrix) + bias
 
 
-def norm(x, name, _type, _ops, is_train=True):
+def norm(x, name, _type, _ops, is_train=True, data_format='NHWC'):
     if _type == 'batch':
-        return batch_norm(x, name=name, _ops=_ops, is_train=is_train)
+        return batch_norm(x, name=name, _ops=_ops, is_train=is_train, data_format=data_format)
     elif _type == 'instance':
-        return instance_norm(x, name=name)
+        return instance_norm(x, name=name, data_format=data_format)
+    elif _type == 'none':  # batch norm folded into the weights of the previous layer
+        return x
     else:
         raise NotImplementedError
 
 
-def batch_norm(x, name, _ops, is_train=True):
-    """Batch normalization."""
+def batch_norm(x, name, _ops, is_train=True, data_format='NHWC'):
+    """Batch normalization.
+
+    x is a tensor, or the list of the equal sized slices of one batch on the towers. The slices are normalized with
+    the moments of the whole batch, every slice is reduced on its own device and only the moments are combined.
+    """
+    xs = x if isinstance(x, list) else [x]
     with tf.variable_scope(name):
-        params_shape = [x.get_shape()[-1]]
+        params_shape = [xs[0].get_shape()[channel_axis(data_format)]]
 
         beta = tf.get_variable('beta', params_shape, tf.float32,
                                initializer=tf.constant_initializer(0.0, tf.float32))
@@ -100,8 +147,6 @@ def batch_norm(x, name, _ops, is_train=True):
                                 initializer=tf.constant_initializer(1.0, tf.float32))
 
         if is_train is True:
-            mean, variance = tf.nn.moments(x, [0, 1, 2], name='moments')
-
             moving_mean = tf.get_variable('moving_mean', params_shape, tf.float32,
                                           initializer=tf.constant_initializer(0.0, tf.float32),
                                           trainable=False)
@@ -109,36 +154,67 @@ def batch_norm(x, name, _ops, is_train=True):
                                               initializer=tf.constant_initializer(1.0, tf.float32),
                                               trainable=False)
 
+            if len(xs) == 1:
+                mean, variance = tf.nn.moments(xs[0], [0] + spatial_axes(data_format), name='moments')
+            else:
+                tower_moments = []
+                for idx, x_ in enumerate(xs):
+                    with tf.colocate_with(x_):
+                        tower_moments.append(tf.nn.moments(x_, [0] + spatial_axes(data_format),
+                                                           name='moments_{}'.format(idx)))
+                # on the device of the variables, E[x^2] of a slice is its variance + mean^2
+                with tf.colocate_with(moving_mean):
+                    mean = tf.add_n([mean_ for mean_, _ in tower_moments]) / len(xs)
+                    variance = tf.add_n([variance_ + tf.square(mean_) for mean_, variance_ in tower_moments]) / \
+                        len(xs) - tf.square(mean)
+
             _ops.append(moving_averages.assign_moving_average(moving_mean, mean, 0.9))
             _ops.append(moving_averages.assign_moving_average(moving_variance, variance, 0.9))
         else:
             mean = tf.get_variable('moving_mean', params_shape, tf.float32,
                                    initializer=tf.constant_initializer(0.0, tf.float32), trainable=False)
-            variance = tf.get_variable('moving_variance', params_shape, tf.float32, trainable=False)
+            variance = tf.get_variable('moving_variance', params_shape, tf.float32,
+                                       initializer=tf.constant_initializer(1.0, tf.float32), trainable=False)
 
         # epsilon used to be 1e-5. Maybe 0.001 solves NaN problem in deeper net.
-        y = tf.nn.batch_normalization(x, mean, variance, beta, gamma, 1e-5)
-        y.set_shape(x.get_shape())
+        params = [broadcast_channels(param, data_format) for param in [mean, variance, beta, gamma]]
+        if not isinstance(x, list):
+            y = tf.nn.batch_normalization(x, *params, variance_epsilon=1e-5)
+            y.set_shape(x.get_shape())
+            return y
+
+        ys = []
+        for x_ in xs:
+            with tf.colocate_with(x_):
+                ys.append(tf.nn.batch_normalization(x_, *params, variance_epsilon=1e-5))
+            ys[-1].set_shape(x_.get_shape())
+        return ys
+
 
-        return y
+def fold_batch_norm(w, biases, beta, gamma, moving_mean, moving_variance, channel_axis=3, epsilon=1e-5):
+    # gamma * (conv(x, w) + biases - mean) / sqrt(variance + eps) + beta == conv(x, w * scale) + new biases
+    scale = gamma / np.sqrt(moving_variance + epsilon)
+    shape = [1] * w.ndim
+    shape[channel_axis] = -1
+    return w * scale.reshape(shape), (biases - moving_mean) * scale + beta
 
 
-def instance_norm(x, name='instance_norm', mean=1.0, stddev=0.02, epsilon=1e-5):
+def instance_norm(x, name='instance_norm', mean=1.0, stddev=0.02, epsilon=1e-5, data_format='NHWC'):
     with tf.variable_scope(name):
-        depth = x.get_shape()[3]
+        depth = x.get_shape()[channel_axis(data_format)]
         scale = tf.get_variable(
             'scale', [depth], tf.float32,
             initializer=tf.random_normal_initializer(mean=mean, stddev=stddev, dtype=tf.float32))
         offset = tf.get_variable('offset', [depth], initializer=tf.constant_initializer(0.0))
 
         # calcualte mean and variance as instance
-        mean, variance = tf.nn.moments(x, axes=[1, 2], keep_dims=True)
+        mean, variance = tf.nn.moments(x, axes=spatial_axes(data_format), keep_dims=True)
 
         # normalization
         inv = tf.rsqrt(variance + epsilon)
         normalized = (x - mean) * inv
 
-        return scale * normalized + offset
+        return broadcast_channels(scale, data_format) * normalized + broadcast_channels(offset, data_format)
 
 
 def n_res_blocks(x, _ops=None, norm_='instance', is_train=True, num_blocks=6, is_print=False):
@@ -183,6 +259,107 @@ def res_block(x, k, _ops=None, norm_='instance', is_train=True, pad_type=None, n
     return output
 
 
+class ImagePool(object):
+    """History of generated images kept in a variable on the graph.
+
+    query swaps a random half of the batch with images from the history in one gather and one scatter, like
+    utils.ImagePool does image by image. The first pool_size images fill the history and are returned as they are.
+    """
+    def __init__(self, pool_size, image_shape, name='image_pool'):
+        self.pool_size = pool_size
+        with tf.variable_scope(name):
+            self.pool = tf.get_variable('pool', [pool_size] + list(image_shape), tf.float32,
+                                        initializer=tf.constant_initializer(0.0), trainable=False)
+            self.num_imgs = tf.get_variable('num_imgs', [], tf.int32, initializer=tf.constant_initializer(0),
+                                            trainable=False)
+
+    def query(self, imgs):
+        imgs = tf.stop_gradient(imgs)
+        batch_size = tf.shape(imgs)[0]
+        num_imgs = self.num_imgs.read_value()
+
+        # the images of empty slots are written before the gather, the rest of a batch that fills the pool is
+        # swapped with them like in utils.ImagePool
+        fill_slots = num_imgs + tf.range(batch_size)
+        is_filling = fill_slots < self.pool_size
+        fill_op = tf.scatter_update(self.pool, tf.boolean_mask(fill_slots, is_filling),
+                                    tf.boolean_mask(imgs, is_filling))
+
+        with tf.control_dependencies([fill_op]):
+            # every slot is written for the images that do not fill one
+            random_slots = tf.random_uniform([batch_size], minval=0, maxval=self.pool_size, dtype=tf.int32)
+            use_old = tf.logical_and(tf.logical_not(is_filling), tf.random_uniform([batch_size]) < 0.5)
+            outputs = tf.where(use_old, tf.gather(self.pool.read_value(), random_slots), imgs)
+
+        # write after the old images are read, the last image of a slot drawn twice, a scatter with repeated
+        # indices has no defined order
+        swap_slots = tf.boolean_mask(random_slots, use_old)
+        swap_imgs = tf.boolean_mask(imgs, use_old)
+        slots, slot_ids = tf.unique(swap_slots)
+        last_ids = tf.unsorted_segment_max(tf.range(tf.size(swap_slots)), slot_ids, tf.size(slots))
+        with tf.control_dependencies([outputs]):
+            update_op = tf.group(tf.scatter_update(self.pool, slots, tf.gather(swap_imgs, last_ids)),
+                                 tf.assign(self.num_imgs, tf.minimum(num_imgs + batch_size, self.pool_size)))
+
+        return outputs, update_op
+
+
+def recompute(fn, enabled=True):
+    # only the output of fn is kept for the backward pass, the activations inside are recomputed from its inputs
+    return tf.contrib.layers.recompute_grad(fn) if enabled else fn
+
+
+def jit_scope(enabled=True):
+    # ops built inside are clustered and compiled by XLA, ops without an XLA kernel stay out of the clusters and run
+    # as usual. The compiled programs are cached per session and input shapes, only the first run pays the compile
+    if not enabled:
+        return contextlib.ExitStack()
+    return tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True, separate_compiled_gradients=False)
+
+
+def device_scope(device):
+    # tf.device(None) would also drop the device functions of the enclosing scopes, e.g. replica_device_setter
+    if device is None:
+        return contextlib.ExitStack()
+    return tf.device(device)
+
+
+def on_towers(fn, xs, devices):
+    # fn on the slice of every tower on its device, the towers after the first reuse the variables of the first
+    if len(xs) == 1:
+        return [fn(xs[0])]
+
+    outputs = []
+    for idx, (x, device) in enumerate(zip(xs, devices)):
+        with device_scope(device), tf.variable_scope(tf.get_variable_scope(), reuse=True if idx > 0 else None,
+                                                     auxiliary_name_scope=False):
+            outputs.append(fn(x))
+    return outputs
+
+
+def tower_device(device, ps_device='/cpu:0'):
+    # variables stay on ps_device and are shared by all the towers, every other op runs on device
+    def _assign(op):
+        node_def = op if isinstance(op, tf.NodeDef) else op.node_def
+        if node_def.op in ['Variable', 'VariableV2', 'VarHandleOp']:
+            return ps_device
+        return device
+    return _assign
+
+
+def average_gradients(tower_grads):
+    # [[(grad, var), ...] of every tower] -> [(mean grad, var), ...]
+    if len(tower_grads) == 1:
+        return tower_grads[0]
+
+    average_grads = []
+    for grads_and_vars in zip(*tower_grads):
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        grad = tf.reduce_mean(tf.stack(grads), axis=0) if len(grads) > 0 else None
+        average_grads.append((grad, grads_and_vars[0][1]))
+    return average_grads
+
+
 def identity(x, name='identity', is_print=False):
     output = tf.identity(x, name=name)
     if is_print: